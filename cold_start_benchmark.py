@@ -0,0 +1,79 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+######### ################## ################## #########
+######### measures the cold start of each cloud function entry point
+######### every run uses a fresh interpreter, so nothing is cached between runs
+#########
+######### python cold_start_benchmark.py [--runs 5] [--call]
+#########   --call also invokes the entry point, this needs credentials and config/config.json
+######### ################## ################## #########
+
+# modules each entry point imports on its first call, keep in sync with main.py
+ENTRY_POINTS = {
+    "create_template_and_tag": {
+        "modules": ["utils.tmpl_operation", "utils.tag_operation", "utils.taxonomy_operation", "utils.policy_tag_operation"],
+        "args": ["request1", "request2"],
+    },
+    "extract_datacatalog_data": {
+        "modules": ["utils.extract_catalog"],
+        "args": ["request1"],
+    },
+}
+
+SDK_MODULES = ["google.cloud.datacatalog", "google.cloud.bigquery", "google.cloud.storage",
+               "google.cloud.dlp_v2", "google.cloud.pubsub_v1"]
+
+CHILD_CODE = """
+import importlib, json, sys, time
+entry_point, modules, args, call = json.loads(sys.argv[1])
+result = {}
+start = time.perf_counter()
+import main
+result["import_main"] = time.perf_counter() - start
+start = time.perf_counter()
+for module in modules:
+    importlib.import_module(module)
+result["import_pipeline"] = time.perf_counter() - start
+if call:
+    start = time.perf_counter()
+    getattr(main, entry_point)(*args)
+    result["first_call"] = time.perf_counter() - start
+result["sdks"] = [name for name in json.loads(sys.argv[2]) if name in sys.modules]
+print("BENCHMARK " + json.dumps(result))
+"""
+
+def run_once(entry_point, call):
+    spec = ENTRY_POINTS[entry_point]
+    child_args = json.dumps([entry_point, spec["modules"], spec["args"], call])
+    proc = subprocess.run([sys.executable, "-c", CHILD_CODE, child_args, json.dumps(SDK_MODULES)],
+                          universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCHMARK "):
+            return json.loads(line[len("BENCHMARK "):])
+    raise RuntimeError(f"{entry_point} failed:\n{proc.stderr}")
+
+def summarize(entry_point, results):
+    print(f"\n{entry_point} ({len(results)} runs)")
+    for metric in ["import_main", "import_pipeline", "first_call"]:
+        values = [result[metric] * 1000 for result in results if metric in result]
+        if values:
+            print(f"  {metric:<16} median {statistics.median(values):8.1f} ms   min {min(values):8.1f} ms   max {max(values):8.1f} ms")
+    print(f"  sdks loaded      {', '.join(results[-1]['sdks']) or '-'}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the cloud function entry points")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--call", action="store_true", help="also time the first call of each entry point")
+    parser.add_argument("--entry-point", choices=sorted(ENTRY_POINTS), action="append")
+    args = parser.parse_args()
+
+    for entry_point in args.entry_point or sorted(ENTRY_POINTS):
+        results = [run_once(entry_point, args.call) for _ in range(args.runs)]
+        summarize(entry_point, results)
+
+if __name__ == "__main__":
+    main()
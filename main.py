@@ -1,19 +1,76 @@
-from utils.tmpl_operation import create_tag_template_from_file
-from utils.tag_operation import read_and_attach_tag
-from utils.extract_catalog import extract_datacatalog
-from utils.taxonomy_operation import create_taxonomy_from_file
-from utils.policy_tag_operation import read_and_attach_policy_tag, auto_attach_policy_tag
-# from utils.dlp_operation import extract_dlp_config
+# pipelines are imported inside the entry points so each function only loads the sdks it needs,
+# run cold_start_benchmark.py to measure the effect on cold starts
+
+# pipelines run by a full scan, in this order
+PIPELINES = ["templates", "tags", "taxonomies", "policy_tags"]
+
+def run_pipeline(pipeline, file_name=None):
+    # process file_name only, or every file in the landing folder of the pipeline when none is given
+    if pipeline == "templates":
+        from utils.tmpl_operation import create_tag_template_from_file
+        create_tag_template_from_file(file_name)
+    elif pipeline == "tags":
+        from utils.tag_operation import read_and_attach_tag
+        read_and_attach_tag(file_name)
+    elif pipeline == "taxonomies":
+        from utils.taxonomy_operation import create_taxonomy_from_file
+        create_taxonomy_from_file(file_name)
+    elif pipeline == "policy_tags":
+        from utils.policy_tag_operation import read_and_attach_policy_tag
+        read_and_attach_policy_tag(file_name)
+
+def get_pipeline_routes(job_config):
+    # landing bucket, object prefix and file suffix read by each pipeline
+    return {
+        "templates": (job_config["template_landing_bucket"], f"{job_config['template_folder']}/template", ".json"),
+        "tags": (job_config["tag_landing_bucket"], f"{job_config['tag_folder']}/", ".csv"),
+        "taxonomies": (job_config["taxonomy_landing_bucket"], f"{job_config['taxonomy_folder']}/taxonomy", ".json"),
+        "policy_tags": (job_config["policy_tag_landing_bucket"], f"{job_config['policy_tag_folder']}/", ".csv"),
+    }
+
+def route_object(job_config, bucket, name):
+    # pipeline owning an uploaded object, None for objects no pipeline reads, e.g. a file outside the pipeline folders
+    routes = get_pipeline_routes(job_config)
+    for pipeline in PIPELINES:
+        landing_bucket, prefix, suffix = routes[pipeline]
+        if bucket == landing_bucket and name.startswith(prefix) and name.endswith(suffix):
+            return pipeline
+    return None
 
 def create_template_and_tag(request1, request2):
-    create_tag_template_from_file()
-    read_and_attach_tag()
-    create_taxonomy_from_file()
-    read_and_attach_policy_tag()
-    
+    # request1 is the event of the finalized object when triggered by gcs, request2 its context.
+    # in "event" trigger mode only that object is processed, by the pipeline owning its folder.
+    # "scan" mode, a local run, a call without an object or an object in a bucket which is not a landing bucket,
+    # e.g. a separate trigger bucket, runs every pipeline over its whole landing folder.
+    from utils.utils import read_json
+    job_config = read_json("config/config.json")
+    event = request1 if isinstance(request1, dict) else {}
+    landing_buckets = set(route[0] for route in get_pipeline_routes(job_config).values())
+
+    if (job_config.get("trigger_mode", "event") == "event" and event.get("name") and not job_config["run_local"]
+            and event.get("bucket") in landing_buckets):
+        pipeline = route_object(job_config, event.get("bucket"), event["name"])
+        if pipeline is None:
+            print(f"Ignored: gs://{event.get('bucket')}/{event['name']}")
+            return
+        print(f"Processing gs://{event['bucket']}/{event['name']} with the {pipeline} pipeline")
+        run_pipeline(pipeline, event["name"])
+    else:
+        for pipeline in PIPELINES:
+            run_pipeline(pipeline)
+
 def extract_datacatalog_data(request1):
+    from utils.extract_catalog import extract_datacatalog
     extract_datacatalog()
 
+def replay_failed_rows(request1):
+    # retries only the rows of the error files which failed on quota or transient errors
+    from utils.tag_operation import replay_tag_errors
+    from utils.policy_tag_operation import replay_policy_tag_errors
+    replay_tag_errors()
+    replay_policy_tag_errors()
+
 
 # create_template_and_tag("request1", "request2")
 # extract_datacatalog_data("request1")
+# replay_failed_rows("request1")
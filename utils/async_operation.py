@@ -0,0 +1,240 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import datacatalog
+from google.api_core import exceptions as api_exceptions
+from utils.rate_limit import call_api_async, call_api_pages_async
+import utils.tag_operation as tag_opr
+import utils.tmpl_operation as tmpl_opr
+import utils.policy_tag_operation as pt_opr
+import utils.taxonomy_operation as taxo_opr
+from utils.error_rows import classify_errors_async, pop_error_reason, merge_error_reasons
+
+def run_async(coro):
+    # run a coroutine to completion for synchronous callers such as the cloud function entry points
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # already inside an event loop, run it on a separate thread with its own loop
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+async def run_in_thread(func, *args):
+    # run a blocking call, e.g. bigquery or dlp, without stalling the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
+
+async def close_client(client):
+    close = getattr(client.transport, "close", None)
+    if close is not None:
+        await close()
+
+async def run_rows_async(rows, partition_key, handler, concurrency, progress_every=500):
+    # await handler(row) for every row with at most `concurrency` rows in flight.
+    # rows with the same partition key run one after another in file order.
+    # returns the rows for which handler returned False or raised, in their original order.
+    semaphore = asyncio.Semaphore(concurrency)
+    locks = {}
+    failed = []
+    pending = set()
+    counter = {"done": 0}
+    start = time.monotonic()
+
+    async def handle(index, row, lock):
+        try:
+            async with lock:
+                try:
+                    result = await handler(row)
+                except Exception as e:
+                    print(f"Row {index + 1} failed: {e}")
+                    result = False
+            if result == False:
+                failed.append((index, row))
+            counter["done"] += 1
+            if counter["done"] % progress_every == 0:
+                elapsed = time.monotonic() - start
+                print(f"Progress: {counter['done']} rows processed, {counter['done'] / max(elapsed, 1e-6):.1f} rows/s")
+        finally:
+            semaphore.release()
+
+    for index, row in enumerate(rows):
+        await semaphore.acquire()
+        lock = locks.setdefault(partition_key(row), asyncio.Lock())
+        task = asyncio.ensure_future(handle(index, row, lock))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.gather(*pending)
+
+    elapsed = time.monotonic() - start
+    done = counter["done"]
+    print(f"Processed {done} rows in {elapsed:.1f}s ({done / max(elapsed, 1e-6):.1f} rows/s), {len(failed)} failed")
+    return [row for index, row in sorted(failed, key=lambda item: item[0])]
+
+######### tag pipeline
+
+async def get_cached_template_async(client, project_id, template_id, location):
+    cached = tmpl_opr.lookup_cached_template(project_id, template_id, location)
+    if cached is None:
+        tmpl = await call_api_async("datacatalog_read", client.get_tag_template, name=f"projects/{project_id}/locations/{location}/tagTemplates/{template_id}")
+        cached = tmpl_opr.cache_template(project_id, template_id, location, tmpl)
+    return cached
+
+async def get_entry_async(client, project, dataset, table):
+    resource_name = tag_opr.get_linked_resource(project, dataset, table)
+    entry_name = tag_opr.get_cached_entry(resource_name)
+    if entry_name is None:
+        try:
+            table_entry = await call_api_async("datacatalog_read", client.lookup_entry, request={"linked_resource": resource_name})
+            entry_name = table_entry.name
+        except tag_opr.ENTRY_NOT_FOUND_ERRORS:
+            entry_name = ""
+        tag_opr.cache_entry(resource_name, entry_name)
+    return entry_name
+
+async def load_entry_tags_async(client, table_entry):
+    entry_tags = tag_opr.get_indexed_tags(table_entry)
+    if entry_tags is None:
+        tags = await call_api_pages_async("datacatalog_read", client.list_tags, datacatalog.ListTagsRequest(parent=table_entry), "tags")
+        entry_tags = tag_opr.index_entry_tags(table_entry, tags)
+    return entry_tags
+
+async def write_tag_async(client, entry, tag, existing_tag):
+    action = tag_opr.prepare_tag_write(tag, existing_tag)
+    if action == "Attached":
+        tag = await call_api_async("datacatalog_write", client.create_tag, parent=entry, tag=tag)
+    elif action == "Updated":
+        tag = await call_api_async("datacatalog_write", client.update_tag, tag=tag, update_mask=tag_opr.TAG_UPDATE_MASK)
+    else:
+        tag = existing_tag
+    return tag_opr.record_written_tag(await load_entry_tags_async(client, entry), tag), action
+
+async def attach_tag_async(client, project, template, template_location, tag_info, flag_auto_policy_tag):
+    # asyncio counterpart of tag_operation.attach_tag, the outcomes are handled by the same helpers
+    print(f"Creating tag using template : {template}, location: {template_location}")
+    tmpl, field_types = await get_cached_template_async(client, project, template, template_location)
+    tag, result_tag_info = tag_opr.build_tag(tmpl, field_types, tag_info)
+    if not tag.fields:
+        return tag_opr.template_field_mismatch(tag_info)
+
+    dataset, table = tag_opr.get_tag_target(result_tag_info)
+    target = f"{project}.{dataset}.{table}"
+
+    try:
+        entry = await get_entry_async(client, project, dataset, table)
+    except api_exceptions.GoogleAPICallError as e:
+        return tag_opr.entry_lookup_failed(tag_info, target, e)
+    if not entry:
+        return tag_opr.entry_not_found(tag_info, target)
+
+    try:
+        existing_tag = (await load_entry_tags_async(client, entry)).get(tag_opr.get_tag_key(tag))
+        tag, action = await write_tag_async(client, entry, tag, existing_tag)
+    except api_exceptions.GoogleAPICallError as e:
+        return tag_opr.tag_write_failed(tag_info, tag, target, e)
+    tag_opr.tag_written(tag, action, target)
+    if flag_auto_policy_tag:
+        await run_in_thread(pt_opr.auto_attach_policy_tag, result_tag_info)    # for policy tagging
+    return True
+
+async def attach_tag_info_async(client, project_id, tag_info, default_tmpl_loc):
+    # asyncio counterpart of tag_operation.attach_tag_info
+    tmplt_loc = tag_opr.get_row_template_location(tag_info, default_tmpl_loc)
+
+    if 'template_id' in tag_info.keys() and tag_info['template_id'] != "":
+        result = await attach_tag_async(client, project_id, tag_info['template_id'], tmplt_loc, tag_info, True)
+    else:
+        reasons = []
+        flg_auto_policy_tag = True
+        latest_tmpl_list = await run_in_thread(tmpl_opr.get_all_latest_template_id, project_id, "template_", tmplt_loc)
+        for tmpl in latest_tmpl_list:
+            result = await classify_errors_async(
+                lambda row: attach_tag_async(client, project_id, tmpl, tmplt_loc, row, flg_auto_policy_tag))(tag_info)
+            reasons.append(pop_error_reason(tag_info, result))
+            flg_auto_policy_tag = False
+        result = merge_error_reasons(tag_info, reasons)
+    await run_in_thread(tag_opr.delete_dlp_table, project_id, tag_info)
+    return result
+
+async def attach_tag_rows_async(project_id, tag_info_list, default_tmpl_loc, concurrency):
+    # the async clients are bound to the running loop, so one is created per run and shared by all rows
+    client = datacatalog.DataCatalogAsyncClient()
+    try:
+        return await run_rows_async(tag_info_list, tag_opr.tag_row_entry,
+                                    classify_errors_async(lambda tag_info: attach_tag_info_async(client, project_id, tag_info, default_tmpl_loc)),
+                                    concurrency)
+    finally:
+        await close_client(client)
+
+######### template pipeline
+
+async def create_template_async(client, project_id, tmpl_cfg):
+    location = tmpl_cfg["location"]
+    tmpl_id = await run_in_thread(tmpl_opr.generate_template_version, project_id, tmpl_cfg["template_id"], location)
+    tag_template = tmpl_opr.build_template(tmpl_cfg["display_name"], tmpl_cfg["fields"])
+    parent = f"projects/{project_id}/locations/{location}"
+    try:
+        tag_template = await call_api_async("datacatalog_write", client.create_tag_template, parent=parent, tag_template_id=tmpl_id, tag_template=tag_template)
+    except api_exceptions.AlreadyExists:
+        # delete template when existed
+        await call_api_async("datacatalog_write", client.delete_tag_template, name=f"{parent}/tagTemplates/{tmpl_id}", force=True)
+        print(f"Deleted: {parent}/tagTemplates/{tmpl_id}")
+        tag_template = await call_api_async("datacatalog_write", client.create_tag_template, parent=parent, tag_template_id=tmpl_id, tag_template=tag_template)
+    tmpl_opr.record_created_template(project_id, tmpl_id, location)
+    print(f"Created template: {tag_template.name}")
+    return True
+
+async def create_templates_async(project_id, tmpl_cfg_list, concurrency, on_created=None):
+    # configs for the same template id are created one after another so each gets its own version
+    client = datacatalog.DataCatalogAsyncClient()
+
+    async def create(item):
+        result = await create_template_async(client, project_id, item[1])
+        if result and on_created:
+            await run_in_thread(on_created, item[0])
+        return result
+
+    def template_key(item):
+        # a config missing these fails in create, not here, so the other configs still run
+        return (item[1].get("template_id"), item[1].get("location"))
+
+    try:
+        failed = await run_rows_async(list(enumerate(tmpl_cfg_list)), template_key, create, concurrency)
+    finally:
+        await close_client(client)
+    failed_index = set(index for index, tmpl_cfg in failed)
+    return [index not in failed_index for index in range(len(tmpl_cfg_list))]
+
+######### policy tag pipeline
+
+async def get_taxonomies_async(client, project_id, location, display_name):
+    index = taxo_opr.lookup_taxonomy_index(project_id, location)
+    if index is None:
+        request = datacatalog.ListTaxonomiesRequest(parent=f"projects/{project_id}/locations/{location}")
+        taxonomies = await call_api_pages_async("policytag", client.list_taxonomies, request, "taxonomies")
+        index = taxo_opr.cache_taxonomy_index(project_id, location, taxonomies)
+    return index.get(display_name, "")
+
+async def get_policy_tag_async(client, taxonomy, display_name):
+    index = pt_opr.lookup_policy_tag_index(taxonomy)
+    if index is None:
+        policy_tags = await call_api_pages_async("policytag", client.list_policy_tags, datacatalog.ListPolicyTagsRequest(parent=taxonomy), "policy_tags")
+        index = pt_opr.cache_policy_tag_index(taxonomy, policy_tags)
+    return index.get(display_name, "")
+
+async def queue_policy_tag_info_async(client, project_id, policy_tag_info, coalescer):
+    # asyncio counterpart of policy_tag_operation.queue_policy_tag_info
+    taxonomy = await get_taxonomies_async(client, project_id, policy_tag_info["taxonomy_location"], policy_tag_info["taxonomy"])
+    policy_tag = await get_policy_tag_async(client, taxonomy, policy_tag_info["policy_tag"]) if taxonomy else ""
+    return pt_opr.queue_policy_tag(policy_tag_info, policy_tag, coalescer)
+
+async def queue_policy_tag_rows_async(project_id, policy_tag_info_list, coalescer, concurrency):
+    client = datacatalog.PolicyTagManagerAsyncClient()
+    try:
+        return await run_rows_async(policy_tag_info_list, pt_opr.policy_tag_row_table,
+                                    classify_errors_async(lambda policy_tag_info: queue_policy_tag_info_async(client, project_id, policy_tag_info, coalescer)),
+                                    concurrency)
+    finally:
+        await close_client(client)
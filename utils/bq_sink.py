@@ -0,0 +1,150 @@
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import bigquery
+from utils.client_pool import get_bigquery_client
+from utils.rate_limit import call_api
+from utils.gcs_operation import upload_string_to_gcs, upload_file_to_gcs
+from utils.extract_format import EXTRACT_FORMATS, CONTENT_TYPES, get_load_job_config, open_extract_writer
+
+DEFAULT_BATCH_BYTES = 16 * 1024 * 1024
+DEFAULT_SHARD_ROWS = 500000
+STAGING_SUFFIX = "_staging"
+
+class BigQuerySink:
+    # writer that loads its rows to a bigquery table with load_table_from_file every batch_bytes,
+    # so memory stays flat however many rows are written and nothing is written to local disk.
+    # a single batch is loaded straight over the table. several batches are loaded to a staging table
+    # and copied over the table on close, so readers never see a partially loaded table.
+
+    def __init__(self, project_id, table_id, columns, schema, batch_bytes=DEFAULT_BATCH_BYTES,
+                 archive_bucket=None, archive_prefix=None, extract_format="csv"):
+        self.project_id = project_id
+        self.table_id = table_id
+        self.staging_table_id = f"{table_id}{STAGING_SUFFIX}"
+        self.columns = columns
+        self.schema = schema
+        self.batch_bytes = batch_bytes
+        self.extract_format = extract_format
+        # every batch is also uploaded as a part file to gs://archive_bucket/archive_prefix_partNNNNN
+        self.archive_bucket = archive_bucket
+        self.archive_prefix = archive_prefix
+        self.batches = 0
+        self.rows = 0
+        self._new_buffer()
+
+    def _new_buffer(self):
+        self.buffer = io.BytesIO()
+        self.writer = open_extract_writer(self.extract_format, self.buffer, self.columns, self.schema)
+        self.buffered = 0
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.buffered += 1
+        if self.buffer.tell() >= self.batch_bytes:
+            self._load_batch(self.staging_table_id)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _load_batch(self, table_id):
+        self.writer.close()
+        data = self.buffer.getvalue()
+        rows = self.buffered
+        self._new_buffer()
+
+        client = get_bigquery_client(self.project_id)
+        write_disposition = bigquery.WriteDisposition.WRITE_APPEND if self.batches else bigquery.WriteDisposition.WRITE_TRUNCATE
+        job_config = get_load_job_config(self.extract_format, self.schema, write_disposition)
+        load_job = call_api("bigquery", client.load_table_from_file, io.BytesIO(data), table_id, job_config=job_config)
+        load_job.result()  # Waits for the job to complete.
+        if self.archive_bucket:
+            suffix = EXTRACT_FORMATS[self.extract_format][0]
+            upload_string_to_gcs(self.project_id, self.archive_bucket, data,
+                                 f"{self.archive_prefix}_part{self.batches:05d}{suffix}", CONTENT_TYPES[self.extract_format])
+        self.batches += 1
+        self.rows += rows
+        print(f"Loaded batch {self.batches} ({rows} rows) to: {table_id}")
+
+    def close(self):
+        if self.batches == 0:
+            self._load_batch(self.table_id)
+        else:
+            if self.buffered:
+                self._load_batch(self.staging_table_id)
+            client = get_bigquery_client(self.project_id)
+            job_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+            call_api("bigquery", client.copy_table, self.staging_table_id, self.table_id, job_config=job_config).result()
+            client.delete_table(self.staging_table_id, not_found_ok=True)
+        print(f"Loaded {self.rows} rows to: {self.project_id}.{self.table_id}")
+        return self.rows
+
+class ShardedGcsWriter:
+    # writer that splits rows into local shard files of at most shard_rows rows. every finished shard is
+    # uploaded to gcs on a pool of upload_workers threads while the next one is written, close() returns
+    # the wildcard uri matching all shards so they can be loaded with a single load job.
+
+    def __init__(self, project_id, columns, schema, file_prefix, bucket, gcs_prefix, shard_rows=DEFAULT_SHARD_ROWS,
+                 upload_workers=4, extract_format="csv", keep_local=False):
+        self.project_id = project_id
+        self.columns = columns
+        self.schema = schema
+        self.file_prefix = file_prefix
+        self.bucket = bucket
+        self.gcs_prefix = gcs_prefix
+        self.shard_rows = shard_rows
+        self.extract_format = extract_format
+        self.suffix = EXTRACT_FORMATS[extract_format][0]
+        # shards are removed once uploaded unless they are kept, e.g. when running locally
+        self.keep_local = keep_local
+        self.upload_workers = upload_workers
+        self.executor = ThreadPoolExecutor(max_workers=upload_workers)
+        self.uploads = deque()
+        self.shards = 0
+        self.rows = 0
+        self._open_shard()
+
+    def _open_shard(self):
+        self.file_name = f"{self.file_prefix}_{self.shards:05d}{self.suffix}"
+        self.file = open(self.file_name, "wb")
+        self.writer = open_extract_writer(self.extract_format, self.file, self.columns, self.schema)
+        self.shard_written = 0
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.shard_written += 1
+        self.rows += 1
+        if self.shard_written >= self.shard_rows:
+            self._finish_shard()
+            self._open_shard()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _upload(self, file_name, destination):
+        upload_file_to_gcs(self.project_id, self.bucket, file_name, destination)
+        if not self.keep_local:
+            os.remove(file_name)
+
+    def _finish_shard(self):
+        self.writer.close()
+        self.file.close()
+        destination = f"{self.gcs_prefix}_{self.shards:05d}{self.suffix}"
+        self.uploads.append(self.executor.submit(self._upload, self.file_name, destination))
+        self.shards += 1
+        # at most two shards per upload worker wait on local disk, the writer waits for the oldest upload otherwise
+        while len(self.uploads) > self.upload_workers * 2:
+            self.uploads.popleft().result()
+
+    def close(self):
+        self._finish_shard()
+        try:
+            while self.uploads:
+                self.uploads.popleft().result()
+        finally:
+            self.executor.shutdown(wait=True)
+        print(f"Uploaded {self.rows} rows in {self.shards} shards to: gs://{self.bucket}/{self.gcs_prefix}_*{self.suffix}")
+        return f"gs://{self.bucket}/{self.gcs_prefix}_*{self.suffix}"
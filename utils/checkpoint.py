@@ -0,0 +1,144 @@
+import itertools
+import json
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from utils.client_pool import get_storage_client
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+DEFAULT_CHECKPOINT_ROWS = 1000
+DEFAULT_CHECKPOINT_FOLDER = "checkpoints"
+
+class CheckpointConflict(Exception):
+    # another invocation took over the checkpoint of a file, the file is left to it
+    pass
+
+class FileCheckpoint:
+    # progress of a landing file, kept in a "{folder}/{landing bucket}/{blob}.checkpoint" object of the checkpoint bucket,
+    # away from the landing bucket so saving it never triggers the function: the generation of the file, how many rows
+    # from the start are done, the part objects holding the failed rows and whether the file is complete.
+    # the failed rows of each chunk go to their own part object, so a save never uploads the rows of earlier chunks.
+    # a checkpoint of another generation belongs to an earlier upload of the file and is ignored.
+    # every write is conditional on the generation of the checkpoint this invocation read or wrote last, so of two
+    # invocations working on the same file the one whose write fails raises CheckpointConflict and stops.
+
+    def __init__(self, bucket, blob_name, generation, size, checkpoint_bucket, checkpoint_name):
+        self.bucket = bucket
+        self.blob_name = blob_name
+        self.checkpoint_bucket = checkpoint_bucket
+        self.checkpoint_blob = checkpoint_bucket.blob(checkpoint_name)
+        self.checkpoint_generation = 0    # 0 makes the first write fail when the checkpoint already exists
+        self.generation = generation
+        self.size = size
+        self.offset = 0
+        self.parts = []
+        self.complete = False
+
+    def _load(self):
+        blob = self.checkpoint_bucket.get_blob(self.checkpoint_blob.name)
+        if blob is None:
+            return
+        try:
+            checkpoint = json.loads(blob.download_as_string(if_generation_match=blob.generation))
+        except (NotFound, PreconditionFailed):
+            raise CheckpointConflict(f"checkpoint of {self.blob_name} changed while reading it")
+        self.checkpoint_generation = blob.generation
+        if checkpoint.get("generation") == self.generation:
+            self.offset = checkpoint["offset"]
+            self.parts = checkpoint["parts"]
+            self.complete = checkpoint["complete"]
+            print(f"Resuming {self.blob_name} after row {self.offset}")
+
+    def _write(self, offset, parts, complete):
+        checkpoint = {"generation": self.generation, "offset": offset, "parts": parts, "complete": complete}
+        try:
+            self.checkpoint_blob.upload_from_string(json.dumps(checkpoint), content_type="application/json",
+                                                    if_generation_match=self.checkpoint_generation)
+        except PreconditionFailed:
+            raise CheckpointConflict(f"checkpoint of {self.blob_name} taken over by another invocation")
+        self.checkpoint_generation = self.checkpoint_blob.generation
+        self.offset = offset
+        self.parts = parts
+        self.complete = complete
+
+    def claim(self):
+        # read the checkpoint and write it straight back, so an invocation already working on the file
+        # fails its next save and a second one started at the same time fails here
+        self._load()
+        self._write(self.offset, self.parts, self.complete)
+
+    def save(self, offset, failed_rows, complete=False):
+        # a part is named after the checkpoint generation it follows and must not exist yet,
+        # so it is never overwritten, not by a chunk redone after a crash nor by another invocation
+        part = None
+        if failed_rows:
+            part = f"{self.checkpoint_blob.name}.{self.checkpoint_generation}"
+            try:
+                self.checkpoint_bucket.blob(part).upload_from_string(json.dumps(failed_rows), content_type="application/json",
+                                                                     if_generation_match=0)
+            except PreconditionFailed:
+                raise CheckpointConflict(f"checkpoint of {self.blob_name} taken over by another invocation")
+        try:
+            self._write(offset, self.parts + [part] if part else self.parts, complete)
+        except CheckpointConflict:
+            if part:
+                self._delete(part)
+            raise
+
+    def iter_failed_rows(self):
+        # failed rows of the file in order, read back one part at a time
+        for part in self.parts:
+            for row in json.loads(self.checkpoint_bucket.blob(part).download_as_string()):
+                yield row
+
+    def cleanup_objects(self):
+        # (bucket, name, generation) of the checkpoint and of every part object next to it, including parts
+        # left by a crash before their checkpoint was saved, deleted once the file is archived.
+        # the checkpoint is only deleted while it is still the one written by this invocation.
+        bucket_name = self.checkpoint_bucket.name
+        prefix = f"{self.checkpoint_blob.name}."
+        return [(bucket_name, self.checkpoint_blob.name, self.checkpoint_generation)] + \
+               [(bucket_name, blob.name, None) for blob in self.checkpoint_bucket.list_blobs(prefix=prefix)]
+
+    def _delete(self, name, generation=None):
+        try:
+            self.checkpoint_bucket.delete_blob(name, if_generation_match=generation)
+        except (NotFound, PreconditionFailed):
+            pass
+
+    def delete(self):
+        for bucket_name, name, generation in self.cleanup_objects():
+            self._delete(name, generation)
+
+def open_checkpoint(project_id, bucket_name, blob_name, checkpoint_bucket_name, checkpoint_folder=DEFAULT_CHECKPOINT_FOLDER):
+    # claimed checkpoint of a landing file, None when the file is gone because another invocation already moved it
+    # to .done, or when another invocation is working on it
+    client = get_storage_client(project_id)
+    bucket = client.bucket(bucket_name)
+    blob = bucket.get_blob(blob_name)
+    if blob is None:
+        print(f"Skipped, already processed: {blob_name}")
+        return None
+    checkpoint = FileCheckpoint(bucket, blob_name, blob.generation, blob.size, client.bucket(checkpoint_bucket_name),
+                                f"{checkpoint_folder}/{bucket_name}/{blob_name}{CHECKPOINT_SUFFIX}")
+    try:
+        checkpoint.claim()
+    except CheckpointConflict as e:
+        print(f"Skipped, {e}")
+        return None
+    return checkpoint
+
+def process_with_checkpoint(rows, checkpoint, process_rows, chunk_rows=DEFAULT_CHECKPOINT_ROWS):
+    # run process_rows(chunk) -> failed rows over chunks of the rows after the checkpoint, saving it after every chunk,
+    # so a retried invocation carries on from the last saved chunk. returns the failed rows of the whole file,
+    # read back from the parts once the file is complete. raises CheckpointConflict when another invocation
+    # took the file over.
+    if not checkpoint.complete:
+        offset = checkpoint.offset
+        rows = itertools.islice(rows, offset, None)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            if not chunk:
+                break
+            offset += len(chunk)
+            checkpoint.save(offset, process_rows(chunk))
+        checkpoint.save(offset, [], complete=True)
+    return list(checkpoint.iter_failed_rows())
@@ -0,0 +1,68 @@
+import threading
+
+# process wide registry of google api clients.
+# clients are created on first use and reused across rows, files and warm cloud function invocations.
+_clients = {}
+_lock = threading.Lock()
+
+def _new_client(kind, project_id):
+    # sdk imports are kept inside the factory so a pipeline only loads the clients it uses
+    if kind == "datacatalog":
+        from google.cloud import datacatalog
+        return datacatalog.DataCatalogClient()
+    if kind == "policy_tag_manager":
+        from google.cloud import datacatalog
+        return datacatalog.PolicyTagManagerClient()
+    if kind == "bigquery":
+        from google.cloud import bigquery
+        return bigquery.Client(project=project_id)
+    if kind == "storage":
+        from google.cloud import storage
+        return storage.Client(project=project_id)
+    if kind == "dlp":
+        from google.cloud import dlp_v2
+        return dlp_v2.DlpServiceClient()
+    if kind == "subscriber":
+        from google.cloud import pubsub_v1
+        return pubsub_v1.SubscriberClient()
+    raise ValueError(f"Unknown client type: {kind}")
+
+def get_client(kind, project_id=None):
+    # return the shared client for (kind, project), creating it once per process
+    key = (kind, project_id)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _new_client(kind, project_id)
+                _clients[key] = client
+    return client
+
+def set_client(kind, client, project_id=None):
+    # register a client explicitly, e.g. a fake client in tests
+    with _lock:
+        _clients[(kind, project_id)] = client
+
+def reset_clients():
+    # drop every cached client so the next call creates fresh ones
+    with _lock:
+        _clients.clear()
+
+def get_datacatalog_client():
+    return get_client("datacatalog")
+
+def get_policy_tag_manager_client():
+    return get_client("policy_tag_manager")
+
+def get_bigquery_client(project_id):
+    return get_client("bigquery", project_id)
+
+def get_storage_client(project_id):
+    return get_client("storage", project_id)
+
+def get_dlp_client():
+    return get_client("dlp")
+
+def get_subscriber_client():
+    return get_client("subscriber")
@@ -1,14 +1,22 @@
-from google.cloud import dlp_v2, bigquery, pubsub_v1
 # from utils.policy_tag_operation import attach_policy_tag, get_policy_tag
-from utils.gcs_operation import list_file_gcs, read_json_gcs, move_file_gcs
+from utils.gcs_operation import list_file_gcs, read_json_gcs
+from utils.gcs_archiver import GcsArchiver
 from utils.taxonomy_operation import create_taxonomy, get_taxonomies
 from utils.utils import read_json
+from utils.client_pool import get_bigquery_client, get_dlp_client, get_subscriber_client
+from utils.rate_limit import call_api
+import atexit
 import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait as futures_wait
 from google.cloud.exceptions import NotFound
 
+# the bigquery and pubsub sdks are imported where they are used to keep cold starts short
 def create_bq_dlp_table(project_id, dataset_id, table_name):
+    from google.cloud import bigquery
 
-    bq_client = bigquery.Client(project=project_id)
+    bq_client = get_bigquery_client(project_id)
     table_id = f"{project_id}.{dataset_id}.{table_name}"
 
     json_schema = read_json("config/dlp_bq_table_schema.json")
@@ -27,6 +35,7 @@ def create_bq_dlp_table(project_id, dataset_id, table_name):
     return True
 
 def get_field_schema(field):
+    from google.cloud import bigquery
     name = field['name']
     field_type = field.get('field_type', "STRING")
     mode = field.get('mode', "NULLABLE")
@@ -46,19 +55,13 @@ def get_field_schema(field):
 
     return field_schema
 
-def create_dlp_job(project_id, dataset_id, table_id, info_types, row_limit, location, topic_id, sub_id, timeout):
-
-    dlp_client = dlp_v2.DlpServiceClient()
-
-    topic = pubsub_v1.PublisherClient.topic_path(project_id, topic_id)
-    subscriber = pubsub_v1.SubscriberClient()
-    subscription_path = subscriber.subscription_path(project_id, sub_id)
-
-    bq_client = bigquery.Client(project_id)
+DLP_POLL_INTERVAL = 30
+DLP_MAX_JOBS = 10
+RELEASED_JOBS = 1000
 
-    parent = f"projects/{project_id}/locations/{location}"
-
-    inspect_job_data = {
+def build_inspect_job(project_id, dataset_id, table_id, info_types, row_limit, topic_id):
+    # inspect job saving its findings to {table_id}_DLP and announcing its completion on the topic
+    return {
         "storage_config": {
             "big_query_options": {
                 "table_reference": {
@@ -87,42 +90,186 @@ def create_dlp_job(project_id, dataset_id, table_id, info_types, row_limit, loca
                     }
                 }
             },
-            {"pub_sub": {"topic": topic}}
+            {"pub_sub": {"topic": f"projects/{project_id}/topics/{topic_id}"}}
         ]
     }
 
-    try:
-        bq_client.get_table(f"{project_id}.{dataset_id}.{table_id}_DLP")
-        operation = dlp_client.create_dlp_job(
-            parent=parent, inspect_job=inspect_job_data
-        )
-
-        job_done = threading.Event()
-
-        def callback(message):
+class DlpJobManager:
+    # runs dlp inspect jobs concurrently, with one streaming pull on the completion subscription for all of them.
+    # a completion message resolves the future of its job by the DlpJobName attribute. messages of jobs started
+    # elsewhere are dropped, so they expire and are redelivered to the process waiting for them, and messages of
+    # jobs this manager stopped waiting for are acked. a poller checks pending jobs with
+    # get_dlp_job every poll_interval seconds in case a message never arrives. at most max_jobs run at once,
+    # submit waits for a free slot otherwise.
+
+    def __init__(self, project_id, sub_id, poll_interval=DLP_POLL_INTERVAL, max_jobs=DLP_MAX_JOBS):
+        self.project_id = project_id
+        self.subscription_path = get_subscriber_client().subscription_path(project_id, sub_id)
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        # names of the jobs given up on, e.g. timed out, whose completion messages nobody waits for
+        self.released = deque(maxlen=RELEASED_JOBS)
+        self.streaming_pull = None
+        self.poller = None
+        self._slots = threading.BoundedSemaphore(max_jobs)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.streaming_pull = get_subscriber_client().subscribe(self.subscription_path, callback=self._on_message)
+        self.poller = threading.Thread(target=self._poll, daemon=True)
+        self.poller.start()
+        return self
+
+    def submit(self, dataset_id, table_id, info_types, row_limit, location, topic_id, timeout=None):
+        # start an inspect job of a table and return the future of its DlpJob, raises NotFound without a findings
+        # table and TimeoutError when no job slot frees up within timeout seconds
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"no free DLP job slot for {dataset_id}.{table_id} within {timeout}s")
+        try:
+            get_bigquery_client(self.project_id).get_table(f"{self.project_id}.{dataset_id}.{table_id}_DLP")
+            job = call_api("dlp", get_dlp_client().create_dlp_job, parent=f"projects/{self.project_id}/locations/{location}",
+                           inspect_job=build_inspect_job(self.project_id, dataset_id, table_id, info_types, row_limit, topic_id))
+        except BaseException:
+            self._slots.release()
+            raise
+        future = Future()
+        future.job_name = job.name
+        with self._lock:
+            self.jobs[job.name] = future
+        print(f"DLP Job started: {job.name}")
+        return future
+
+    def wait(self, futures, timeout):
+        # wait up to timeout seconds and return the futures of the jobs which completed.
+        # jobs still running are left to finish on their own and are no longer tracked.
+        done, not_done = futures_wait(futures, timeout=timeout)
+        for future in not_done:
+            print(f"DLP Job timed out: {future.job_name}")
+            self._release(future.job_name)
+        completed = []
+        for future in done:
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                print(f"DLP Job failed: {future.job_name} >> {future.exception()}")
+                continue
+            print(f"DLP Job Completed: {future.job_name}")
+            completed.append(future)
+        return completed
+
+    def _release(self, job_name):
+        with self._lock:
+            future = self.jobs.pop(job_name, None)
+            if future is not None:
+                self.released.append(job_name)
+        if future is not None:
+            self._slots.release()
+            future.cancel()
+
+    def _resolve(self, job):
+        from google.cloud import dlp_v2
+        with self._lock:
+            future = self.jobs.pop(job.name, None)
+        # the subscriber and the poller may both see a job finish, the first one resolves it
+        if future is None:
+            return
+        self._slots.release()
+        if job.state == dlp_v2.DlpJob.JobState.DONE:
+            future.set_result(job)
+        else:
+            future.set_exception(RuntimeError(f"DLP job {job.state.name}: {list(job.errors)}"))
+
+    def _on_message(self, message):
+        job_name = message.attributes.get("DlpJobName")
+        with self._lock:
+            known = job_name in self.jobs
+            released = job_name in self.released
+        if released:
+            message.ack()
+            return
+        if not known:
+            # a nack would redeliver it at once to every subscriber, dropped it expires first
+            message.drop()
+            return
+        message.ack()
+        try:
+            self._resolve(call_api("dlp", get_dlp_client().get_dlp_job, name=job_name))
+        except Exception as e:
+            # the poller picks the job up on its next round
+            print(f"DLP Job lookup failed: {job_name} >> {e}")
+
+    def _poll(self):
+        from google.cloud import dlp_v2
+        finished = (dlp_v2.DlpJob.JobState.DONE, dlp_v2.DlpJob.JobState.FAILED, dlp_v2.DlpJob.JobState.CANCELED)
+        while not self._stopped.wait(self.poll_interval):
+            with self._lock:
+                job_names = list(self.jobs)
+            for job_name in job_names:
+                try:
+                    job = call_api("dlp", get_dlp_client().get_dlp_job, name=job_name)
+                except Exception as e:
+                    print(f"DLP Job lookup failed: {job_name} >> {e}")
+                    continue
+                if job.state in finished:
+                    self._resolve(job)
+
+    def shutdown(self):
+        # stop the streaming pull and the poller, jobs still pending are cancelled for their waiters
+        self._stopped.set()
+        if self.streaming_pull is not None:
+            self.streaming_pull.cancel()
             try:
-                if message.attributes["DlpJobName"] == operation.name:
-                    message.ack()
-                    print("DLP Job Completed")
-                    job_done.set()
-                else:
-                    message.drop()
-            except Exception as e:
-                print(e)
-                raise
-
-        subscriber.subscribe(subscription_path, callback=callback)
-        finished = job_done.wait(timeout=timeout)
-        if not finished:
-            print("Job timed out.")
-
-        return table_id + "_DLP"
+                self.streaming_pull.result(timeout=30)
+            except Exception:
+                pass
+        if self.poller is not None:
+            self.poller.join()
+        with self._lock:
+            pending = list(self.jobs)
+        for job_name in pending:
+            self._release(job_name)
+
+# one running job manager per (project, subscription), shared by every thread of the process
+_dlp_job_managers = {}
+_dlp_job_managers_lock = threading.Lock()
+
+def get_dlp_job_manager(project_id, sub_id):
+    key = (project_id, sub_id)
+    with _dlp_job_managers_lock:
+        manager = _dlp_job_managers.get(key)
+        if manager is None:
+            manager = DlpJobManager(project_id, sub_id).start()
+            _dlp_job_managers[key] = manager
+    return manager
+
+def shutdown_dlp_job_managers():
+    # called at the end of a run, the next dlp job starts a new subscriber
+    with _dlp_job_managers_lock:
+        managers = list(_dlp_job_managers.values())
+        _dlp_job_managers.clear()
+    for manager in managers:
+        manager.shutdown()
+
+atexit.register(shutdown_dlp_job_managers)
+
+def create_dlp_job(project_id, dataset_id, table_id, info_types, row_limit, location, topic_id, sub_id, timeout):
+    # run one inspect job on the shared job manager, concurrent callers share its subscriber
+    manager = get_dlp_job_manager(project_id, sub_id)
+    deadline = time.monotonic() + timeout
+    try:
+        future = manager.submit(dataset_id, table_id, info_types, row_limit, location, topic_id, timeout)
     except NotFound:
         print(f"{project_id}.{dataset_id}.{table_id} Not Found.")
-    
+        return None
+    except TimeoutError as e:
+        print(f"DLP Job not started: {e}")
+        return None
+    manager.wait([future], max(0, deadline - time.monotonic()))
+    return table_id + "_DLP"
 
 def read_dlp_from_bq_table(project_id, dataset_id, table_name, min_count):
-    bq_client = bigquery.Client(project=project_id)
+    bq_client = get_bigquery_client(project_id)
 
     query = f"""
     SELECT
@@ -198,7 +345,7 @@ def create_taxonomy_from_dlp(project_id, location, dlp_fields, taxonomy_name):
 #     return True
 
 def delete_dlp_bq_table(project_id, dataset_id, table_id):
-    client = bigquery.Client(project=project_id)
+    client = get_bigquery_client(project_id)
     table_name = f"{project_id}.{dataset_id}.{table_id}"
     try:
         client.get_table(table_name)
@@ -212,15 +359,21 @@ def extract_dlp_config():
     landing_bucket = job_config["dlp_landing_bucket"]
     archive_bucket = job_config["dlp_archive_bucket"]
     dlp_folder = job_config["dlp_folder"]
-    file_list = list_file_gcs(project_id, landing_bucket, dlp_folder)
-    for dlp_file in file_list:
-        if(dlp_file[-5:] == (".json")):
-            json_info = read_json_gcs(project_id, landing_bucket, dlp_file)
-            [result, dataset_id, dlp_table_name] = run_dlp_from_config(json_info)
-
-            if(result):
-                move_file_gcs(project_id, landing_bucket, dlp_file, archive_bucket, f"{dlp_folder}/{dlp_file.split('/')[-1]}.done")
-                delete_dlp_bq_table(project_id, dataset_id, dlp_table_name)
+    archiver = GcsArchiver(project_id)
+    try:
+        file_list = list_file_gcs(project_id, landing_bucket, dlp_folder)
+        for dlp_file in file_list:
+            if(dlp_file[-5:] == (".json")):
+                json_info = read_json_gcs(project_id, landing_bucket, dlp_file)
+                [result, dataset_id, dlp_table_names] = run_dlp_from_config(json_info)
+
+                if(result):
+                    archiver.add(landing_bucket, dlp_file, archive_bucket, f"{dlp_folder}/{dlp_file.split('/')[-1]}.done")
+                    for dlp_table_name in dlp_table_names:
+                        delete_dlp_bq_table(project_id, dataset_id, dlp_table_name)
+    finally:
+        archiver.archive()
+        shutdown_dlp_job_managers()
 
 def run_dlp_from_config(config_json):
     try:
@@ -241,12 +394,30 @@ def run_dlp_from_config(config_json):
         if(table_name not in table_list):
             table_list.append(table_name)
 
-        create_bq_dlp_table(project_id, dataset_id, table_name+"_DLP")
-        dlp_table_name = create_dlp_job(project_id, dataset_id, table_name, info_types, max_rows, location, topic_id, sub_id, dlp_timeout)
-        dlp_fields = read_dlp_from_bq_table(project_id, dataset_id, dlp_table_name, min_count)
+        # every table of the list is scanned at once, their findings make up one taxonomy
+        # dlp_timeout bounds the whole scan, waiting for a job slot included
+        manager = get_dlp_job_manager(project_id, sub_id)
+        deadline = time.monotonic() + dlp_timeout
+        futures = {}
+        for table in table_list:
+            create_bq_dlp_table(project_id, dataset_id, table+"_DLP")
+            try:
+                futures[table] = manager.submit(dataset_id, table, info_types, max_rows, location, topic_id,
+                                                max(0, deadline - time.monotonic()))
+            except NotFound:
+                print(f"{project_id}.{dataset_id}.{table} Not Found.")
+            except TimeoutError as e:
+                print(f"DLP Job not started: {e}")
+        completed = manager.wait(list(futures.values()), max(0, deadline - time.monotonic()))
+
+        dlp_fields = []
+        dlp_table_names = [table+"_DLP" for table in futures]
+        for table, future in futures.items():
+            if future in completed:
+                dlp_fields.extend(read_dlp_from_bq_table(project_id, dataset_id, table+"_DLP", min_count))
         create_taxonomy_from_dlp(project_id, taxonomy_location, dlp_fields, taxonomy_name)
         # add_tags_from_dlp(project_id, dataset_id, table_list, dlp_fields, taxonomy_name, taxonomy_location)
-        return [True, dataset_id, dlp_table_name]
+        return [True, dataset_id, dlp_table_names]
     except Exception as e:
         print(e)
-        return [False, "", ""]
+        return [False, "", []]
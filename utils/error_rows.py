@@ -0,0 +1,128 @@
+import csv
+import io
+import os
+from utils.utils import iter_tag_csv
+from utils.gcs_operation import list_file_gcs, iter_csv_gcs, upload_string_to_gcs, delete_file_gcs
+from utils.rate_limit import QUOTA_ERRORS, RETRYABLE_ERRORS
+
+# why a row failed, written to the error_reason column of the error file
+ENTRY_NOT_FOUND = "ENTRY_NOT_FOUND"
+COLUMN_NOT_FOUND = "COLUMN_NOT_FOUND"
+TEMPLATE_FIELD_MISMATCH = "TEMPLATE_FIELD_MISMATCH"
+POLICY_TAG_NOT_FOUND = "POLICY_TAG_NOT_FOUND"
+QUOTA = "QUOTA"
+TRANSIENT = "TRANSIENT"
+ERROR = "ERROR"
+# only these rows are retried on replay, the others fail again until the file or the catalog is fixed
+RETRYABLE_REASONS = (QUOTA, TRANSIENT)
+ERROR_REASON = "error_reason"
+
+def get_error_reason(error):
+    # errors reaching a row have already been retried by call_api, so quota and transient errors
+    # only mean the retries ran out and the row may succeed later
+    if isinstance(error, QUOTA_ERRORS):
+        return QUOTA
+    if isinstance(error, RETRYABLE_ERRORS):
+        return TRANSIENT
+    return ERROR
+
+def set_error_reason(row, reason):
+    # record why a row failed, returns False so handlers can return it as their result
+    if row is not None:
+        row[ERROR_REASON] = reason
+    return False
+
+def pop_error_reason(row, result):
+    # take the outcome of one handler off the row before the next handler runs on it,
+    # None when the handler succeeded and its error reason otherwise
+    reason = row.pop(ERROR_REASON, None)
+    return None if result else reason or ERROR
+
+def merge_error_reasons(row, reasons):
+    # result of a row handled once per template, from the reason each template returned with pop_error_reason.
+    # a template whose fields do not match the row does not apply to it, any other failure fails the row
+    # even when other templates tagged it, with a retryable reason first so the row is replayed.
+    failures = [reason for reason in reasons if reason is not None and reason != TEMPLATE_FIELD_MISMATCH]
+    if failures:
+        retryable = [reason for reason in failures if reason in RETRYABLE_REASONS]
+        return set_error_reason(row, (retryable or failures)[0])
+    if None in reasons:
+        return True
+    return set_error_reason(row, TEMPLATE_FIELD_MISMATCH if reasons else ERROR)
+
+def classify_errors(handler):
+    # wrap a row handler so an exception fails the row with the reason of the error
+    def handle(row):
+        try:
+            return handler(row)
+        except Exception as e:
+            print(f"Row failed: {e}")
+            return set_error_reason(row, get_error_reason(e))
+    return handle
+
+def classify_errors_async(handler):
+    # asyncio counterpart of classify_errors
+    async def handle(row):
+        try:
+            return await handler(row)
+        except Exception as e:
+            print(f"Row failed: {e}")
+            return set_error_reason(row, get_error_reason(e))
+    return handle
+
+def error_rows_to_csv(rows):
+    # csv of the failed rows with error_reason as the last column
+    columns = {}
+    for row in rows:
+        for column in row:
+            if column != ERROR_REASON:
+                columns[column] = True
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, list(columns) + [ERROR_REASON], restval="")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(dict(row, **{ERROR_REASON: row.get(ERROR_REASON) or ERROR}))
+    return buffer.getvalue()
+
+def write_error_rows(project_id, rows, path, bucket_name=None):
+    # write the failed rows of a file in one go, to gcs when a bucket is given and locally otherwise
+    data = error_rows_to_csv(rows)
+    if bucket_name:
+        upload_string_to_gcs(project_id, bucket_name, data, path, "text/csv")
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", newline="") as error_file:
+            error_file.write(data)
+    print(f"{len(rows)} failed rows written to: {path}")
+
+def get_error_file_name(folder, file_name):
+    # error file of a landing file, a replayed error file keeps its name
+    return f"{folder}/error/error_{file_name.split('/')[-1].replace('error_', '')}"
+
+def list_error_files(project_id, folder, bucket_name=None):
+    if bucket_name:
+        return [name for name in list_file_gcs(project_id, bucket_name, f"{folder}/error/") if name.endswith(".csv")]
+    if not os.path.isdir(f"{folder}/error/"):
+        return []
+    return [f"{folder}/error/{name}" for name in sorted(os.listdir(f"{folder}/error/")) if name.endswith(".csv")]
+
+def replay_error_files(project_id, folder, process_rows, bucket_name=None):
+    # run process_rows(rows) -> failed rows over the retryable rows of every error file in folder/error/.
+    # each file is rewritten with the rows still failing, and removed once none are left.
+    for error_file in list_error_files(project_id, folder, bucket_name):
+        rows = list(iter_csv_gcs(project_id, bucket_name, error_file) if bucket_name else iter_tag_csv(error_file))
+        kept_rows = [row for row in rows if row.get(ERROR_REASON) not in RETRYABLE_REASONS]
+        retry_rows = [{column: value for column, value in row.items() if column != ERROR_REASON}
+                      for row in rows if row.get(ERROR_REASON) in RETRYABLE_REASONS]
+        if not retry_rows:
+            print(f"Nothing to replay in: {error_file}")
+            continue
+
+        failed_rows = kept_rows + process_rows(retry_rows)
+        print(f"Replayed {len(retry_rows)} rows of {error_file}, {len(failed_rows)} rows still failing")
+        if failed_rows:
+            write_error_rows(project_id, failed_rows, error_file, bucket_name)
+        elif bucket_name:
+            delete_file_gcs(project_id, bucket_name, error_file)
+        else:
+            os.remove(error_file)
@@ -1,113 +1,299 @@
 from google.cloud import bigquery
-import csv
+from google.api_core.exceptions import NotFound, GoogleAPICallError
+import time
 from datetime import datetime
-from utils.utils import read_json
-from utils.tag_operation import get_tag_info
-from utils.gcs_operation import upload_file_to_gcs
+from utils.utils import read_json, dict_to_json
+from utils.client_pool import get_bigquery_client
+from utils.rate_limit import call_api
+from utils.parallel import map_ordered
+from utils.tag_operation import get_tag_info, get_linked_resource, cache_entry, search_entries
+from utils.gcs_operation import upload_file_to_gcs, read_json_gcs, write_json_gcs
 from utils.tmpl_operation import get_template_info, list_template
+from utils.bq_sink import BigQuerySink, ShardedGcsWriter, STAGING_SUFFIX
+from utils.extract_format import EXTRACT_FORMATS, get_extract_format, get_load_job_config, open_extract_writer
 
-def extract_all_template_info_to_file(project_id, file_path):
-    run_date = datetime.today().strftime('%Y%m%d%H%M%S')
-    csv_name = f"{file_path}template_info_{run_date}.csv"
-
-    print(f"Extracting template info to file : {csv_name}")
-    with open(csv_name, 'w') as csv_file:
-        # write csv header
-        writer = csv.DictWriter(csv_file, ["project_id", "template_id", "template_display_name", "template_loc", 
-                "field_id", "field_display_name", "field_type", "field_allowed_values",
-                "requried_field", "field_description", "extract_timestamp"])
-        writer.writeheader()
-        templates = list_template(project_id)
-        for tmpl in templates:
-            tmpl_id = tmpl.split('/')[-1]
-            tmpl_loc = tmpl.split('/')[3]
-            tmpl_info = get_template_info(project_id, tmpl_id, tmpl_loc)
-            print(f"Writing template info for: {tmpl_loc}, {tmpl_id}")
-            for row in tmpl_info:
-                row["extract_timestamp"] = run_date
-                writer.writerow(row)
-    print("Extract finished.")
-    return csv_name
-
-def extract_all_tag_info_to_file(project_id, file_path):
-    client = bigquery.Client(project = project_id)
-    client.list_datasets()
-    datasets = client.list_datasets(project_id)
-
-    run_date = datetime.today().strftime('%Y%m%d%H%M%S')
-    csv_name = f"{file_path}tag_info_{run_date}.csv"
-
-    print(f"Extracting tag info to file : {csv_name}")
-    with open(csv_name, 'w') as csv_file:
-        # write csv header
-        writer = csv.DictWriter(csv_file, ["project_id", "dataset_name", "table_name", "column_name", "template_id", 
-                                            "template_location", "tag_field_id", "tag_field_value", "extract_timestamp"])
-        writer.writeheader()
-
-        for dataset in datasets:
-            dataset_name = dataset.dataset_id
-            # get tags for dataset level
-            dataset_tag = get_tag_info(project_id, dataset_name)
-            if dataset_tag:
-                # write dataset tags to csv
-                print(f"Writing tag info for: {dataset_name}")
-                for row in dataset_tag:
-                    row["extract_timestamp"] = run_date
-                    writer.writerow(row)
+# start time of the last extract, kept next to the extract files
+WATERMARK_FILE = "tag_extract_watermark.json"
+# tables modified while the previous extract was running are extracted again
+WATERMARK_OVERLAP = 300
+
+TEMPLATE_INFO_COLUMNS = ["project_id", "template_id", "template_display_name", "template_loc", 
+                         "field_id", "field_display_name", "field_type", "field_allowed_values",
+                         "requried_field", "field_description", "extract_timestamp"]
+TAG_INFO_COLUMNS = ["project_id", "dataset_name", "table_name", "column_name", "template_id", 
+                    "template_location", "tag_field_id", "tag_field_value", "extract_timestamp"]
+
+def write_template_info(project_id, extract_time, writer):
+    # write the rows of every template in the project
+    templates = list_template(project_id)
+    for tmpl in templates:
+        tmpl_id = tmpl.split('/')[-1]
+        tmpl_loc = tmpl.split('/')[3]
+        tmpl_info = get_template_info(project_id, tmpl_id, tmpl_loc)
+        print(f"Writing template info for: {tmpl_loc}, {tmpl_id}")
+        for row in tmpl_info:
+            row["extract_timestamp"] = extract_time
+            writer.writerow(row)
+
+def get_tag_rows(project_id, extract_time, dataset_name, table_name="", entries=None, tag_filter=""):
+    # tag rows of a dataset or table, or one empty row when it has no tags.
+    # entries are the entry names found by a catalog search, they save the lookup_entry call per table.
+    if entries is None:
+        rows = get_tag_info(project_id, dataset_name, table_name)
+    else:
+        linked_resource = get_linked_resource(project_id, dataset_name, table_name)
+        entry_name = entries.get(linked_resource)
+        if entry_name:
+            cache_entry(linked_resource, entry_name)
+            rows = get_tag_info(project_id, dataset_name, table_name)
+        elif tag_filter:
+            # not matched by the tag filter, written as untagged
+            rows = []
+        else:
+            # not in the search index yet, e.g. a new table, fall back to a lookup
+            rows = get_tag_info(project_id, dataset_name, table_name)
+    if not rows:
+        rows = [{"project_id":project_id, "dataset_name":dataset_name, "table_name":table_name,
+                    "column_name":"", "template_id":"", "template_location":"",
+                    "tag_field_id":"", "tag_field_value":""}]
+    for row in rows:
+        row["extract_timestamp"] = extract_time
+    return rows
+
+def list_tag_targets(client, project_id):
+    # every dataset followed by its tables, datasets are sorted so the extract comes out in the same order each run
+    datasets = sorted(client.list_datasets(project_id), key=lambda dataset: dataset.dataset_id)
+    for dataset in datasets:
+        yield (dataset.dataset_id, "")
+        for table in client.list_tables(dataset.dataset_id):
+            yield (dataset.dataset_id, table.table_id)
+
+def query_tag_targets(client, project_id, regions):
+    # every dataset ("" as table name) and table of the project, one INFORMATION_SCHEMA query per region
+    targets = set()
+    for region in regions:
+        query = f"""
+        SELECT schema_name AS dataset_name, '' AS table_name
+        FROM `{project_id}.region-{region.lower()}.INFORMATION_SCHEMA.SCHEMATA`
+        UNION ALL
+        SELECT table_schema AS dataset_name, table_name
+        FROM `{project_id}.region-{region.lower()}.INFORMATION_SCHEMA.TABLES`
+        """
+        rows = call_api("bigquery", client.query, query).result()
+        targets.update((row["dataset_name"], row["table_name"]) for row in rows)
+    # a dataset sorts before its tables as its table name is ""
+    return sorted(targets)
+
+def search_tag_entries(project_id, tag_filter=""):
+    # entry names of the datasets and tables in the project, optionally only those matching a tag: filter
+    entries = {}
+    for entry_type in ["dataset", "table"]:
+        entries.update(search_entries(project_id, f"system=bigquery type={entry_type} {tag_filter}".strip()))
+    print(f"Found {len(entries)} catalog entries")
+    return entries
+
+def write_tag_info(project_id, extract_time, writer, targets, workers=1, entries=None, tag_filter=""):
+    # write the tag rows of every (dataset, table) target.
+    # tags are fetched on worker threads, rows are written here in listing order
+    results = map_ordered(targets, lambda target: (target, get_tag_rows(project_id, extract_time, *target,
+                                                                         entries=entries, tag_filter=tag_filter)), workers)
+    for (dataset_name, table_name), rows in results:
+        if rows[0]["template_id"]:
+            if table_name:
+                print(f"Writing tag info for: {dataset_name}.{table_name}")
             else:
-                tmp_dict = {"project_id":project_id, "dataset_name":dataset_name, "table_name":"", "column_name":"", 
-                                "template_id":"", "template_location":"",
-                                "tag_field_id":"", "tag_field_value":"", "extract_timestamp":run_date}
-                writer.writerow(tmp_dict)
-
-            tables = client.list_tables(dataset_name)
-            for table in tables:
-                table_name = table.table_id
-                # get tags for table and column level
-                table_tag = get_tag_info(project_id, dataset_name, table_name)
-                if table_tag:
-                    # write table tags to csv
-                    print(f"Writing tag info for: {dataset_name}.{table_name}")
-                    for row in table_tag:
-                        row["extract_timestamp"] = run_date
-                        writer.writerow(row)
-                else:
-                    tmp_dict = {"project_id":project_id, "dataset_name":dataset_name, "table_name":table_name, 
-                                    "column_name":"", "template_id":"", "template_location":"", 
-                                     "tag_field_id":"", "tag_field_value":"", "extract_timestamp":run_date}
-                    writer.writerow(tmp_dict)
+                print(f"Writing tag info for: {dataset_name}")
+        writer.writerows(rows)
 
-    print("Extract finished.")
-    return csv_name
+def get_tag_targets(client, project_id, mode="list", regions=None, tag_filter=""):
+    # mode "list" walks datasets and tables through the bigquery api and looks up each entry,
+    # mode "search" enumerates them per region and takes entry names from a catalog search
+    if mode == "search":
+        return search_tag_entries(project_id, tag_filter), query_tag_targets(client, project_id, regions)
+    return None, list_tag_targets(client, project_id)
+
+######### incremental extract
+
+def read_watermark(project_id, run_local, bucket, gcs_folder):
+    # start time of the last successful extract, None when there is none
+    try:
+        if run_local:
+            watermark = read_json(f"catalog_extract/{WATERMARK_FILE}")
+        else:
+            watermark = read_json_gcs(project_id, bucket, f"{gcs_folder}/{WATERMARK_FILE}")
+        return float(watermark["last_extract"])
+    except (OSError, ValueError, KeyError, NotFound):
+        return None
+
+def write_watermark(project_id, run_local, bucket, gcs_folder, started):
+    watermark = {"last_extract": started, "last_extract_time": datetime.utcfromtimestamp(started).isoformat()}
+    if run_local:
+        dict_to_json(watermark, f"catalog_extract/{WATERMARK_FILE}")
+    else:
+        write_json_gcs(project_id, bucket, f"{gcs_folder}/{WATERMARK_FILE}", watermark)
+
+def list_dataset_tables(client, project_id, dataset_id):
+    # (table, last modified epoch seconds) of every table in a dataset from a single metadata query
+    query = f"SELECT table_id, last_modified_time FROM `{project_id}.{dataset_id}.__TABLES__`"
+    rows = call_api("bigquery", client.query, query).result()
+    return sorted((row["table_id"], row["last_modified_time"] / 1000) for row in rows)
+
+def search_tagged_entries(project_id):
+    # entry names of every dataset and table carrying a tag of one of the project's templates.
+    # updating a tag changes neither the table nor the entry update time, so these are always extracted again
+    tagged = {}
+    for tmpl in list_template(project_id):
+        tmpl_project, tmpl_id = tmpl.split('/')[1], tmpl.split('/')[-1]
+        tagged.update(search_entries(project_id, f"system=bigquery tag:{tmpl_project}.{tmpl_id}"))
+    return tagged
+
+def list_extracted_tagged_targets(client, project_id, destination):
+    # (dataset, table) of every target with tag rows in the last extract, so removed tags are extracted again
+    query = f"""
+    SELECT DISTINCT dataset_name, IFNULL(table_name, '') AS table_name FROM `{destination}`
+    WHERE project_id = @project_id AND IFNULL(template_id, '') != ''
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("project_id", "STRING", project_id)])
+    try:
+        rows = call_api("bigquery", client.query, query, job_config=job_config).result()
+    except NotFound:
+        return set()
+    return {(row["dataset_name"], row["table_name"]) for row in rows}
+
+def list_changed_tag_targets(client, project_id, since, workers=1, destination=None):
+    # all current datasets and tables, and the ones to extract again: every dataset, tables modified
+    # since the watermark, entries the catalog reports as updated since then, entries tagged now
+    # and targets which had tags in the last extract
+    datasets = sorted(dataset.dataset_id for dataset in client.list_datasets(project_id))
+    # search only filters by day, going back one more day never misses an update
+    updated_since = datetime.utcfromtimestamp(since - 86400).strftime("%Y-%m-%d")
+    updated = search_entries(project_id, f"system=bigquery updatetime>{updated_since}")
+    updated.update(search_tagged_entries(project_id))
+    extracted_tagged = list_extracted_tagged_targets(client, project_id, destination) if destination else set()
 
-def load_file_to_bigquery(project_id, file_gcs_location, destination_dataset, destination_table, schema):
-    client = bigquery.Client(project=project_id)
+    current = []
+    changed = []
+    results = map_ordered(datasets, lambda dataset_id: (dataset_id, list_dataset_tables(client, project_id, dataset_id)), workers)
+    for dataset_id, tables in results:
+        current.append((dataset_id, ""))
+        changed.append((dataset_id, ""))
+        for table_id, modified in tables:
+            current.append((dataset_id, table_id))
+            if (modified >= since or (dataset_id, table_id) in extracted_tagged
+                    or get_linked_resource(project_id, dataset_id, table_id) in updated):
+                changed.append((dataset_id, table_id))
+    print(f"{len(changed)} of {len(current)} datasets and tables changed since the last extract")
+    return current, changed
+
+def merge_tag_info(project_id, destination_dataset, destination_table, staging_table, current):
+    # replace the rows of the extracted tables with the staged ones and drop the rows of deleted tables,
+    # the staging table is dropped once merged. a failed merge leaves it to be overwritten by the next run
+    client = get_bigquery_client(project_id)
+    destination = f"{project_id}.{destination_dataset}.{destination_table}"
+    staging = f"{project_id}.{destination_dataset}.{staging_table}"
+    query = f"""
+    BEGIN TRANSACTION;
+    DELETE FROM `{destination}`
+    WHERE project_id = @project_id
+        AND (CONCAT(dataset_name, '.', IFNULL(table_name, '')) IN (
+                SELECT CONCAT(dataset_name, '.', IFNULL(table_name, '')) FROM `{staging}`)
+            OR CONCAT(dataset_name, '.', IFNULL(table_name, '')) NOT IN UNNEST(@current_targets));
+    INSERT INTO `{destination}` SELECT * FROM `{staging}`;
+    COMMIT TRANSACTION;
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("project_id", "STRING", project_id),
+        bigquery.ArrayQueryParameter("current_targets", "STRING", [f"{dataset}.{table}" for dataset, table in current]),
+    ])
+    call_api("bigquery", client.query, query, job_config=job_config).result()
+    client.delete_table(staging, not_found_ok=True)
+    print(f"Merged {staging} into {destination}")
+
+def load_file_to_bigquery(project_id, file_gcs_location, destination_dataset, destination_table, schema, extract_format="csv"):
+    client = get_bigquery_client(project_id)
     table_id = f"{destination_dataset}.{destination_table}"
 
-    table_schema = []
-    for key, value in schema.items():
-        table_schema.append(bigquery.SchemaField(key, value))
-    
-    job_config = bigquery.LoadJobConfig(
-        schema = table_schema,
-        write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE,
-        skip_leading_rows = 1,
-        # The source format defaults to CSV, so the line below is optional.
-        source_format = bigquery.SourceFormat.CSV,
-    )
-
-    load_job = client.load_table_from_uri(file_gcs_location, table_id, job_config=job_config)
+    job_config = get_load_job_config(extract_format, schema, bigquery.WriteDisposition.WRITE_TRUNCATE)
+
+    load_job = call_api("bigquery", client.load_table_from_uri, file_gcs_location, table_id, job_config=job_config)
     load_job.result()  # Waits for the job to complete.
     destination_table = client.get_table(table_id)
     print(f"Loaded {destination_table.num_rows} rows to: {project_id}.{table_id}")
 
+def upload_and_load(project_id, filename, bucket, gcs_folder, destination_dataset, destination_table, schema, extract_format="csv"):
+    # upload an extracted file to gcs and load it to Bigquery
+    file_path_on_gcs = f"{gcs_folder}/{filename.split('/')[-1]}"
+    upload_file_to_gcs(project_id, bucket, filename, file_path_on_gcs)
+    load_file_to_bigquery(project_id, f"gs://{bucket}/{file_path_on_gcs}", destination_dataset, 
+                            destination_table, schema, extract_format)
+
+def get_extract_time():
+    # extract_timestamp of the rows, loaded as a TIMESTAMP
+    return datetime.utcnow().replace(microsecond=0)
+
+def extract_to_file(file_path, name, columns, schema, extract_format, write_rows):
+    # write_rows(extract_time, writer) writes the rows of the extract to a new file
+    extract_time = get_extract_time()
+    file_name = f"{file_path}{name}_{extract_time.strftime('%Y%m%d%H%M%S')}{EXTRACT_FORMATS[extract_format][0]}"
+
+    print(f"Extracting {name} to file : {file_name}")
+    with open(file_name, 'wb') as extract_file:
+        writer = open_extract_writer(extract_format, extract_file, columns, schema)
+        write_rows(extract_time, writer)
+        writer.close()
+    print("Extract finished.")
+    return file_name
+
+def extract_to_bigquery(job_config, name, columns, write_rows, destination_table, schema):
+    # load the rows written by write_rows(extract_time, writer) to destination_table. "extract_sink": "file" writes
+    # a local file, uploads it to gcs and loads it from there, "sharded" does the same with shard files uploaded
+    # in parallel and loaded by one wildcard load job, "stream" loads batches straight from memory.
+    # "extract_format" is csv, ndjson (gzip compressed) or parquet.
+    project_id = job_config["project_id"]
+    bucket = job_config["extract_bucket"]
+    gcs_folder = job_config["extract_folder"]
+    destination_dataset = job_config["extract_destination_dataset"]
+    streaming = job_config.get("extract_sink", "file") == "stream"
+    extract_format = get_extract_format(job_config.get("extract_format", "csv"), streaming)
+
+    if streaming:
+        extract_time = get_extract_time()
+        # batches are only kept in gcs when archiving is on
+        archive_bucket = bucket if job_config.get("extract_archive", False) else None
+        sink = BigQuerySink(project_id, f"{destination_dataset}.{destination_table}", columns, schema,
+                            job_config.get("extract_batch_mb", 16) * 1024 * 1024, archive_bucket,
+                            f"{gcs_folder}/{name}_{extract_time.strftime('%Y%m%d%H%M%S')}", extract_format)
+        print(f"Extracting {name} to: {project_id}.{destination_dataset}.{destination_table}")
+        write_rows(extract_time, sink)
+        sink.close()
+    elif job_config.get("extract_sink", "file") == "sharded":
+        extract_time = get_extract_time()
+        file_name = f"{name}_{extract_time.strftime('%Y%m%d%H%M%S')}"
+        file_path = "catalog_extract/" if job_config["run_local"] else "/tmp/"
+        writer = ShardedGcsWriter(project_id, columns, schema, f"{file_path}{file_name}", bucket, f"{gcs_folder}/{file_name}",
+                                  job_config.get("extract_shard_rows", 500000), job_config.get("extract_upload_workers", 4),
+                                  extract_format, job_config["run_local"])
+        print(f"Extracting {name} to: gs://{bucket}/{gcs_folder}/{file_name}_*")
+        write_rows(extract_time, writer)
+        load_file_to_bigquery(project_id, writer.close(), destination_dataset, destination_table, schema, extract_format)
+    else:
+        file_path = "catalog_extract/" if job_config["run_local"] else "/tmp/"
+        file_name = extract_to_file(file_path, name, columns, schema, extract_format, write_rows)
+        upload_and_load(project_id, file_name, bucket, gcs_folder, destination_dataset, destination_table, schema, extract_format)
+
 def extract_datacatalog():
     job_config = read_json("config/config.json")
+    started = time.time()
 
     project_id = job_config["project_id"]
+    run_local = job_config["run_local"]
     bucket = job_config["extract_bucket"]
     gcs_folder = job_config["extract_folder"]
     destination_dataset = job_config["extract_destination_dataset"]
+    extract_workers = job_config.get("extract_workers", 1)
+    extract_mode = job_config.get("extract_mode", "list")
+    extract_regions = job_config.get("extract_regions", [job_config["resource_location"]])
+    extract_tag_filter = job_config.get("extract_tag_filter", "")
 
     tmpl_destination_table = job_config["template_extract_destination_table"]
     tag_destination_table = job_config["tag_extract_destination_table"]
@@ -115,28 +301,36 @@ def extract_datacatalog():
     tmpl_table_schema = read_json(job_config["template_extract_table_schema"])
     tag_table_schema = read_json(job_config["tag_extract_table_schema"])
 
-    # extract template info file to local directory
-    if job_config["run_local"]:
-        tmpl_filename = extract_all_template_info_to_file(project_id, "catalog_extract/")
-    else:
-        tmpl_filename = extract_all_template_info_to_file(project_id, "/tmp/")
-
-    # extract tag info file to local directory
-    if job_config["run_local"]:
-        tag_filename = extract_all_tag_info_to_file(project_id, "catalog_extract/")
-    else:
-        tag_filename = extract_all_tag_info_to_file(project_id, "/tmp/")
-
-    # upload extracted files to gcs
-    tmpl_file_path_on_gcs = f"{gcs_folder}/{tmpl_filename.split('/')[-1]}"
-    upload_file_to_gcs(project_id, bucket, tmpl_filename, tmpl_file_path_on_gcs)
-
-    tag_file_path_on_gcs = f"{gcs_folder}/{tag_filename.split('/')[-1]}"
-    upload_file_to_gcs(project_id, bucket, tag_filename, tag_file_path_on_gcs)
+    # templates are few, they are always extracted in full
+    extract_to_bigquery(job_config, "template_info", TEMPLATE_INFO_COLUMNS,
+                        lambda extract_time, writer: write_template_info(project_id, extract_time, writer),
+                        tmpl_destination_table, tmpl_table_schema)
 
-    # load extracted files to Bigquery
-    load_file_to_bigquery(project_id, f"gs://{bucket}/{tmpl_file_path_on_gcs}", destination_dataset, 
-                            tmpl_destination_table, tmpl_table_schema)
+    # tags of the tables changed since the last extract are merged into the tag table,
+    # a full refresh runs when there is no watermark yet or the incremental extract fails
+    client = get_bigquery_client(project_id)
+    since = read_watermark(project_id, run_local, bucket, gcs_folder) if job_config.get("extract_incremental", False) else None
+    if since is not None:
+        try:
+            current, changed = list_changed_tag_targets(client, project_id, since - WATERMARK_OVERLAP, extract_workers,
+                                                        f"{project_id}.{destination_dataset}.{tag_destination_table}")
+            # search mode keeps resolving entries, and applying the tag filter, the same way as a full extract
+            entries = search_tag_entries(project_id, extract_tag_filter) if extract_mode == "search" else None
+            staging_table = f"{tag_destination_table}{STAGING_SUFFIX}"
+            extract_to_bigquery(job_config, "tag_info", TAG_INFO_COLUMNS,
+                                lambda extract_time, writer: write_tag_info(project_id, extract_time, writer, changed,
+                                                                            extract_workers, entries, extract_tag_filter),
+                                staging_table, tag_table_schema)
+            merge_tag_info(project_id, destination_dataset, tag_destination_table, staging_table, current)
+        except GoogleAPICallError as e:
+            # only api errors fall back to a full refresh, anything else is a bug and is raised
+            print(f"Incremental extract failed, running a full refresh: {e}")
+            since = None
+    if since is None:
+        entries, targets = get_tag_targets(client, project_id, extract_mode, extract_regions, extract_tag_filter)
+        extract_to_bigquery(job_config, "tag_info", TAG_INFO_COLUMNS,
+                            lambda extract_time, writer: write_tag_info(project_id, extract_time, writer, targets,
+                                                                        extract_workers, entries, extract_tag_filter),
+                            tag_destination_table, tag_table_schema)
 
-    load_file_to_bigquery(project_id, f"gs://{bucket}/{tag_file_path_on_gcs}", destination_dataset, 
-                            tag_destination_table, tag_table_schema)
\ No newline at end of file
+    write_watermark(project_id, run_local, bucket, gcs_folder, started)
@@ -0,0 +1,109 @@
+import csv
+import gzip
+import io
+import json
+from google.cloud import bigquery
+
+# extract file formats: file suffix and the source format load jobs read them with
+EXTRACT_FORMATS = {
+    "csv": (".csv", bigquery.SourceFormat.CSV),
+    "ndjson": (".json.gz", bigquery.SourceFormat.NEWLINE_DELIMITED_JSON),
+    "parquet": (".parquet", bigquery.SourceFormat.PARQUET),
+}
+CONTENT_TYPES = {"csv": "text/csv", "ndjson": "application/gzip", "parquet": "application/octet-stream"}
+PARQUET_ROW_GROUP = 10000
+
+def get_table_schema(schema):
+    # bigquery schema from a {column: type} json schema
+    return [bigquery.SchemaField(key, value) for key, value in schema.items()]
+
+def get_extract_format(extract_format, streaming=False):
+    # parquet needs pyarrow, which is optional, and is written to files only. ndjson is used instead otherwise.
+    if extract_format == "parquet":
+        if streaming:
+            print("Parquet is not supported for streamed extracts, using ndjson")
+            return "ndjson"
+        try:
+            import pyarrow
+        except ImportError:
+            print("pyarrow is not installed, using ndjson")
+            return "ndjson"
+    return extract_format
+
+def get_load_job_config(extract_format, schema, write_disposition):
+    job_config = bigquery.LoadJobConfig(
+        write_disposition = write_disposition,
+        source_format = EXTRACT_FORMATS[extract_format][1],
+    )
+    # parquet files carry their own typed schema
+    if extract_format != "parquet":
+        job_config.schema = get_table_schema(schema)
+    if extract_format == "csv":
+        job_config.skip_leading_rows = 1
+    return job_config
+
+class ExtractWriter:
+    # writes extract rows to a binary file object, close() finishes the format but leaves the file object open
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+class CsvExtractWriter(ExtractWriter):
+    def __init__(self, fileobj, columns, schema):
+        self.text = io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(self.text, columns)
+        self.writer.writeheader()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()
+
+class NdjsonExtractWriter(ExtractWriter):
+    # gzip compressed newline delimited json, timestamps are written as "YYYY-MM-DD HH:MM:SS"
+    def __init__(self, fileobj, columns, schema):
+        self.columns = columns
+        self.gzip = gzip.GzipFile(fileobj=fileobj, mode="wb")
+
+    def writerow(self, row):
+        record = {column: row.get(column) for column in self.columns}
+        self.gzip.write((json.dumps(record, default=str) + "\n").encode("utf-8"))
+
+    def close(self):
+        self.gzip.close()
+
+class ParquetExtractWriter(ExtractWriter):
+    # rows are buffered and written as row groups of PARQUET_ROW_GROUP rows
+    def __init__(self, fileobj, columns, schema):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        types = {"STRING": pa.string(), "BOOL": pa.bool_(), "BOOLEAN": pa.bool_(), "INTEGER": pa.int64(),
+                 "INT64": pa.int64(), "FLOAT": pa.float64(), "FLOAT64": pa.float64(),
+                 "TIMESTAMP": pa.timestamp("us", tz="UTC")}
+        self.columns = columns
+        self.schema = pa.schema([(column, types[schema[column]]) for column in columns])
+        self.writer = pq.ParquetWriter(fileobj, self.schema)
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= PARQUET_ROW_GROUP:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            data = {column: [row.get(column) for row in self.rows] for column in self.columns}
+            self.writer.write_table(self.pa.Table.from_pydict(data, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def open_extract_writer(extract_format, fileobj, columns, schema):
+    writers = {"csv": CsvExtractWriter, "ndjson": NdjsonExtractWriter, "parquet": ParquetExtractWriter}
+    return writers[extract_format](fileobj, columns, schema)
@@ -0,0 +1,113 @@
+import time
+from google.api_core.exceptions import GoogleAPICallError, NotFound, PreconditionFailed
+from utils.client_pool import get_storage_client
+
+BATCH_SIZE = 100    # most calls a single gcs batch request may hold
+REWRITE_BYTES = 256 * 1024 * 1024
+
+class GcsArchiver:
+    # collects the landing files processed in a run and moves them to their archive bucket at the end:
+    # the copies go out in gcs batch requests of BATCH_SIZE calls, then the sources whose copy succeeded
+    # are deleted the same way. objects larger than REWRITE_BYTES are copied with rewrite calls instead,
+    # resumed with the rewrite token until done, so a large or cross-location copy never times out.
+    # every call goes through the shared storage client of the project. a file added with its generation is
+    # copied from that generation and only deleted while it is still the current one, so a file uploaded again
+    # after it was read stays in landing for the next run.
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.moves = []
+
+    def add(self, bucket_name, blob_name, destination_bucket_name, destination_blob_name, size=None, cleanup=(), generation=None):
+        # cleanup lists other objects to delete with the file as (bucket, name, generation), e.g. its checkpoint,
+        # an object whose generation is given is left alone once it was rewritten.
+        # a file of unknown size is assumed to be small enough for a batched copy.
+        self.moves.append({"bucket": bucket_name, "blob": blob_name, "destination_bucket": destination_bucket_name,
+                           "destination_blob": destination_blob_name, "size": size, "cleanup": list(cleanup),
+                           "generation": generation})
+
+    def _copy(self, client, move):
+        source_bucket = client.bucket(move["bucket"])
+        source_bucket.copy_blob(source_bucket.blob(move["blob"]), client.bucket(move["destination_bucket"]), move["destination_blob"],
+                                source_generation=move["generation"])
+
+    def _copy_batch(self, client, moves):
+        # copy the moves in one batch request and return those which were copied
+        try:
+            with client.batch():
+                for move in moves:
+                    self._copy(client, move)
+            return moves
+        except GoogleAPICallError as e:
+            # a batch only reports its first error, so the copies are redone one by one to find the failed ones
+            print(f"Batched copy failed, copying one by one: {e}")
+        copied = []
+        for move in moves:
+            try:
+                self._copy(client, move)
+                copied.append(move)
+            except NotFound:
+                print(f"Skipped, already archived or uploaded again: gs://{move['bucket']}/{move['blob']}")
+            except GoogleAPICallError as e:
+                print(f"Archive failed: gs://{move['bucket']}/{move['blob']} >> {e}")
+        return copied
+
+    def _rewrite(self, client, move):
+        source = client.bucket(move["bucket"]).blob(move["blob"], generation=move["generation"])
+        destination = client.bucket(move["destination_bucket"]).blob(move["destination_blob"])
+        token, rewritten, total = destination.rewrite(source)
+        while token is not None:
+            print(f"Rewriting gs://{move['bucket']}/{move['blob']}: {rewritten} of {total} bytes")
+            token, rewritten, total = destination.rewrite(source, token=token)
+
+    def _delete_batch(self, client, blobs):
+        try:
+            with client.batch():
+                for bucket_name, blob_name, generation in blobs:
+                    client.bucket(bucket_name).delete_blob(blob_name, if_generation_match=generation)
+            return
+        except GoogleAPICallError as e:
+            print(f"Batched delete failed, deleting one by one: {e}")
+        for bucket_name, blob_name, generation in blobs:
+            try:
+                client.bucket(bucket_name).delete_blob(blob_name, if_generation_match=generation)
+            except NotFound:
+                pass
+            except PreconditionFailed:
+                print(f"Kept, changed since it was read: gs://{bucket_name}/{blob_name}")
+            except GoogleAPICallError as e:
+                print(f"Delete failed: gs://{bucket_name}/{blob_name} >> {e}")
+
+    def archive(self):
+        # move every collected file and return how many were archived. files which could not be copied
+        # stay in the landing bucket, with their cleanup objects, and are picked up again by the next run.
+        if not self.moves:
+            return 0
+        client = get_storage_client(self.project_id)
+        start = time.monotonic()
+
+        batched = [move for move in self.moves if move["size"] is None or move["size"] <= REWRITE_BYTES]
+        copied = []
+        for index in range(0, len(batched), BATCH_SIZE):
+            copied.extend(self._copy_batch(client, batched[index:index + BATCH_SIZE]))
+        for move in self.moves:
+            if move["size"] is not None and move["size"] > REWRITE_BYTES:
+                try:
+                    self._rewrite(client, move)
+                    copied.append(move)
+                except GoogleAPICallError as e:
+                    print(f"Archive failed: gs://{move['bucket']}/{move['blob']} >> {e}")
+
+        deletes = [blob for move in copied for blob in [(move["bucket"], move["blob"], move["generation"])] + move["cleanup"]]
+        for index in range(0, len(deletes), BATCH_SIZE):
+            self._delete_batch(client, deletes[index:index + BATCH_SIZE])
+
+        print(f"Archived {len(copied)} of {len(self.moves)} files in {time.monotonic() - start:.1f}s")
+        self.moves = []
+        return len(copied)
+
+def archive_file(project_id, bucket_name, blob_name, destination_bucket_name, destination_blob_name, generation=None):
+    # archive a single file at once, e.g. right after it was processed, so a run killed later does not process it again
+    archiver = GcsArchiver(project_id)
+    archiver.add(bucket_name, blob_name, destination_bucket_name, destination_blob_name, generation=generation)
+    return archiver.archive()
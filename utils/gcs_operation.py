@@ -1,30 +1,63 @@
+import csv
 import json
-from google.cloud import storage
+from utils.client_pool import get_storage_client
 
 def upload_file_to_gcs(project_id, bucket_name, filename, destination):
-    storage_client = storage.Client(project=project_id)
+    storage_client = get_storage_client(project_id)
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(destination)
     blob.upload_from_filename(filename)
     print(f"File loaded: gs://{bucket_name}/{destination}")
 
+def upload_string_to_gcs(project_id, bucket_name, data, destination, content_type="text/plain"):
+    storage_client = get_storage_client(project_id)
+    bucket = storage_client.bucket(bucket_name)
+    bucket.blob(destination).upload_from_string(data, content_type=content_type)
+    print(f"File loaded: gs://{bucket_name}/{destination}")
+
 def list_file_gcs(project_id, bucketname, prefix):
-    storage_client = storage.Client(project=project_id)
+    storage_client = get_storage_client(project_id)
     blobs = storage_client.list_blobs(bucketname, prefix=prefix)
     file_list = []
     for blob in blobs:
         file_list.append(blob.name)
     return file_list
 
+def file_exists_gcs(project_id, bucketname, blobname):
+    storage_client = get_storage_client(project_id)
+    return storage_client.bucket(bucketname).blob(blobname).exists()
+
 def read_json_gcs(project_id, bucketname, filename):
-    storage_client = storage.Client(project=project_id)
+    storage_client = get_storage_client(project_id)
     bucket = storage_client.get_bucket(bucketname)
     template = bucket.blob(filename)
     template = json.loads(template.download_as_string())
     return template
 
+def read_json_gcs_generation(project_id, bucketname, filename):
+    # json content of a blob and the generation it was read from, None when the blob is gone
+    storage_client = get_storage_client(project_id)
+    blob = storage_client.bucket(bucketname).get_blob(filename)
+    if blob is None:
+        return None, None
+    return json.loads(blob.download_as_string(if_generation_match=blob.generation)), blob.generation
+
+def iter_csv_gcs(project_id, bucketname, blobname, chunk_size=1024 * 1024, generation=None):
+    # yield the rows of a csv blob as they are downloaded, in small chunks so the first row is available at once.
+    # utf-8-sig drops the byte order mark excel puts in front of the header.
+    storage_client = get_storage_client(project_id)
+    blob = storage_client.bucket(bucketname).blob(blobname, generation=generation)
+    with blob.open("rt", encoding="utf-8-sig", newline="", chunk_size=chunk_size) as csvfile:
+        for row in csv.DictReader(csvfile):
+            yield row
+
+def write_json_gcs(project_id, bucketname, filename, obj):
+    storage_client = get_storage_client(project_id)
+    bucket = storage_client.bucket(bucketname)
+    bucket.blob(filename).upload_from_string(json.dumps(obj), content_type="application/json")
+
 def move_file_gcs(project_id, bucketname, blobname, destination_bucket_name, destination_blob_name):
-    storage_client = storage.Client(project=project_id)
+    storage_client = get_storage_client(project_id)
     source_bucket = storage_client.bucket(bucketname)
     source_blob = source_bucket.blob(blobname)
     destination_bucket = storage_client.bucket(destination_bucket_name)
@@ -33,8 +66,13 @@ def move_file_gcs(project_id, bucketname, blobname, destination_bucket_name, des
     )
     source_bucket.delete_blob(blobname)
 
+def delete_file_gcs(project_id, bucketname, blobname):
+    storage_client = get_storage_client(project_id)
+    storage_client.bucket(bucketname).delete_blob(blobname)
+    print(f"File deleted: gs://{bucketname}/{blobname}")
+
 def download_file_gcs(project_id, bucketname, blobname, destination):
-    storage_client = storage.Client(project=project_id)
+    storage_client = get_storage_client(project_id)
     source_bucket = storage_client.bucket(bucketname)
     blob = source_bucket.blob(blobname)
     blob.download_to_filename(destination)
\ No newline at end of file
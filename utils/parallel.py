@@ -0,0 +1,80 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+
+def run_partitioned(rows, partition_key, handler, workers=1, queue_size=100, progress_every=500):
+    # run handler(row) for every row on a bounded pool of worker threads.
+    # rows with the same partition key always go to the same worker, so they are handled in file order.
+    # returns the rows for which handler returned False or raised, in their original order.
+    failed = []
+    lock = threading.Lock()
+    counter = {"done": 0}
+    start = time.monotonic()
+
+    def handle(index, row):
+        try:
+            result = handler(row)
+        except Exception as e:
+            print(f"Row {index + 1} failed: {e}")
+            result = False
+        with lock:
+            if result == False:
+                failed.append((index, row))
+            counter["done"] += 1
+            done = counter["done"]
+        if done % progress_every == 0:
+            elapsed = time.monotonic() - start
+            print(f"Progress: {done} rows processed, {done / max(elapsed, 1e-6):.1f} rows/s")
+
+    if workers <= 1:
+        for index, row in enumerate(rows):
+            handle(index, row)
+    else:
+        queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+
+        def worker(q):
+            while True:
+                item = q.get()
+                if item is _DONE:
+                    return
+                handle(*item)
+
+        threads = [threading.Thread(target=worker, args=(q,), daemon=True) for q in queues]
+        for thread in threads:
+            thread.start()
+        try:
+            for index, row in enumerate(rows):
+                # bounded queues keep memory flat, the producer waits while a worker is busy
+                queues[hash(partition_key(row)) % workers].put((index, row))
+        finally:
+            for q in queues:
+                q.put(_DONE)
+            for thread in threads:
+                thread.join()
+
+    elapsed = time.monotonic() - start
+    done = counter["done"]
+    print(f"Processed {done} rows in {elapsed:.1f}s ({done / max(elapsed, 1e-6):.1f} rows/s), {len(failed)} failed")
+    return [row for index, row in sorted(failed, key=lambda item: item[0])]
+
+def map_ordered(items, func, workers=1, window=None):
+    # yield func(item) for every item in input order while up to `window` calls run on `workers` threads.
+    # results are consumed by the caller's thread only, so it can write them out without locking.
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    window = window or workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            # a full window blocks the producer until the oldest call is written, keeping memory bounded
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,162 +1,282 @@
 from google.cloud import bigquery
 from google.cloud import datacatalog
-from utils.utils import read_json, read_tag_csv
+from utils.utils import read_json, iter_tag_csv
+from utils.client_pool import get_bigquery_client, get_policy_tag_manager_client
 import utils.taxonomy_operation as taxo_opr
-import os, csv
-from utils.gcs_operation import list_file_gcs, download_file_gcs, move_file_gcs, upload_file_to_gcs
-import utils.dlp_operation as dlp_opr
+import os, threading
+from google.api_core.exceptions import NotFound
+from utils.gcs_operation import list_file_gcs, iter_csv_gcs
+from utils.gcs_archiver import GcsArchiver
+from utils.parallel import run_partitioned
+from utils.checkpoint import open_checkpoint, process_with_checkpoint, CheckpointConflict
+from utils.checkpoint import DEFAULT_CHECKPOINT_ROWS, DEFAULT_CHECKPOINT_FOLDER
+from utils.rate_limit import call_api, call_api_pages
+from utils.cache import LRUCache
+from utils.error_rows import set_error_reason, get_error_reason, classify_errors, write_error_rows, get_error_file_name, replay_error_files
+from utils.error_rows import ENTRY_NOT_FOUND, COLUMN_NOT_FOUND, POLICY_TAG_NOT_FOUND
+
+# taxonomy -> {policy tag display name or display name path: policy tag name}
+_policy_tag_index = LRUCache("policy_tag", maxsize=256, ttl=600)
 
 def create_policy_tag(display_name, description, taxonomy, parent_policy_tag = ""):
-    client = datacatalog.PolicyTagManagerClient()
+    client = get_policy_tag_manager_client()
     policy_tag = datacatalog.PolicyTag()
     policy_tag.display_name = display_name
     policy_tag.description = description
     if parent_policy_tag != "":
         policy_tag.parent_policy_tag = parent_policy_tag
-    policy_tag = client.create_policy_tag(parent = taxonomy, policy_tag = policy_tag)
+    policy_tag = call_api("policytag", client.create_policy_tag, parent = taxonomy, policy_tag = policy_tag)
     print(f"""Policy tag "{policy_tag.name}" created.""")
+    invalidate_policy_tag_index(taxonomy)
     return policy_tag
 
 def list_policy_tags(taxonomy):
-    client = datacatalog.PolicyTagManagerClient()
+    client = get_policy_tag_manager_client()
     request = datacatalog.ListPolicyTagsRequest()
     request.parent = taxonomy
 
-    policy_tag = client.list_policy_tags(request=request)
-    result = []
-    for pt in policy_tag:
-        result.append(pt)
-    return result
+    return list(call_api_pages("policytag", client.list_policy_tags, request, "policy_tags"))
+
+def lookup_policy_tag_index(taxonomy):
+    # display name -> policy tag name from the cache, None on a miss
+    return _policy_tag_index.get(taxonomy)
+
+def cache_policy_tag_index(taxonomy, policy_tags):
+    # index every policy tag, nested sub tags included, by display name and by its
+    # display name path, e.g. "PII/Email". when display names repeat the tag closest
+    # to the root wins, then the lowest resource name, so the choice is deterministic.
+    by_name = {pt.name: pt for pt in policy_tags}
+
+    def display_path(pt):
+        names = []
+        while pt is not None:
+            names.insert(0, pt.display_name)
+            pt = by_name.get(pt.parent_policy_tag)
+        return names
+
+    index = {}
+    for names, pt in sorted([(display_path(pt), pt) for pt in policy_tags], key=lambda item: (len(item[0]), item[1].name)):
+        index.setdefault("/".join(names), pt.name)
+        if pt.display_name in index and index[pt.display_name] != pt.name:
+            print(f"""Duplicate policy tag "{pt.display_name}" in {taxonomy}, using {index[pt.display_name]}""")
+        index.setdefault(pt.display_name, pt.name)
+    _policy_tag_index.set(taxonomy, index)
+    return index
+
+def invalidate_policy_tag_index(taxonomy):
+    _policy_tag_index.invalidate(taxonomy)
 
 def get_policy_tag(taxonomy, display_name):
-    policy_tags = list_policy_tags(taxonomy)
-    result = ""
-    for pt in policy_tags:
-        if pt.display_name == display_name:
-            result = pt.name
-    return result
-
-def attach_policy_tag(project_id, dataset_name, table_name, column_list, policy_tag):
-    client = bigquery.Client(project=project_id)
+    index = lookup_policy_tag_index(taxonomy)
+    if index is None:
+        index = cache_policy_tag_index(taxonomy, list_policy_tags(taxonomy))
+    return index.get(display_name, "")
+
+def copy_schema_field(field, policy_tags):
+    return bigquery.SchemaField(name=field.name, 
+                                field_type=field.field_type,
+                                mode=field.mode, 
+                                description=field.description,
+                                fields=field.fields,
+                                policy_tags=policy_tags,
+                                precision=field.precision,
+                                scale=field.scale,
+                                max_length=field.max_length)
+
+def apply_policy_tags(project_id, dataset_name, table_name, assignments):
+    # apply every column -> policy tag assignment of a table with a single schema update
+    client = get_bigquery_client(project_id)
 
     table_id = f"{project_id}.{dataset_name}.{table_name}"
-    table = client.get_table(table_id)
-
-    # get the original schema of the table
-    original_schema = table.schema
+    table = call_api("bigquery", client.get_table, table_id)
 
     # update the original schema with policy tag
     new_schema = []
     attached_columns = []
-    for field in original_schema:
-        if field.name in column_list:
-            new_schema.append(bigquery.SchemaField(name=field.name, 
-                                                field_type=field.field_type,
-                                                mode=field.mode, 
-                                                description=field.description,
-                                                fields=field.fields,
-                                                policy_tags=bigquery.PolicyTagList(names=[policy_tag]),
-                                                precision=field.precision,
-                                                scale=field.scale,
-                                                max_length=field.max_length))
+    schema_changed = False
+    for field in table.schema:
+        if field.name in assignments:
+            policy_tag = assignments[field.name]
+            current_tags = list(field.policy_tags.names) if field.policy_tags else []
+            if current_tags != [policy_tag]:
+                schema_changed = True
+            new_schema.append(copy_schema_field(field, bigquery.PolicyTagList(names=[policy_tag])))
             attached_columns.append(field.name)
         else:
-            new_schema.append(bigquery.SchemaField(name=field.name, 
-                                                field_type=field.field_type,
-                                                mode=field.mode, 
-                                                description=field.description,
-                                                fields=field.fields,
-                                                policy_tags=field.policy_tags,
-                                                precision=field.precision,
-                                                scale=field.scale,
-                                                max_length=field.max_length))
-        
-    table.schema = new_schema
-    table = client.update_table(table, ["schema"])
-    print(f"Policy Tag added to {table_id} :")
-    print(f"policy_tag = {policy_tag}")
-    print(f"columns = {attached_columns}\n")
+            new_schema.append(copy_schema_field(field, field.policy_tags))
+
+    # skip the write when every column already carries its policy tag
+    if schema_changed:
+        table.schema = new_schema
+        table = call_api("bigquery", client.update_table, table, ["schema"])
+        print(f"Policy Tag added to {table_id} :")
+    else:
+        print(f"Policy Tag already attached to {table_id} :")
+    for column in attached_columns:
+        print(f"{column} = {assignments[column]}")
+    print("")
+    return attached_columns
+
+def attach_policy_tag(project_id, dataset_name, table_name, column_list, policy_tag):
+    apply_policy_tags(project_id, dataset_name, table_name, {column: policy_tag for column in column_list})
     return True
 
-def read_and_attach_policy_tag():
+class PolicyTagCoalescer:
+    # collects column -> policy tag assignments per table so that each table schema is written once
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.assignments = {}
+        self.rows = {}
+        self._lock = threading.Lock()
+
+    def add(self, dataset_name, table_name, column_list, policy_tag, row=None):
+        key = (dataset_name, table_name)
+        with self._lock:
+            assignments = self.assignments.setdefault(key, {})
+            for column in column_list:
+                previous = assignments.get(column)
+                if previous is not None and previous != policy_tag:
+                    # a later assignment wins, like a later row in the file would have before
+                    print(f"Column {dataset_name}.{table_name}.{column} assigned twice, {policy_tag} replaces {previous}")
+                assignments[column] = policy_tag
+            self.rows.setdefault(key, []).append((row, column_list))
+
+    def flush(self, workers=1):
+        # write every collected table and return the rows whose table or columns could not be updated
+        failed = {}
+
+        def write_table(key):
+            dataset_name, table_name = key
+            try:
+                attached_columns = apply_policy_tags(self.project_id, dataset_name, table_name, self.assignments[key])
+                reason = COLUMN_NOT_FOUND
+            except NotFound as e:
+                print(f"Table Not Found: {self.project_id}.{dataset_name}.{table_name} >> {e}")
+                attached_columns, reason = [], ENTRY_NOT_FOUND
+            except Exception as e:
+                print(f"Policy Tag update failed: {self.project_id}.{dataset_name}.{table_name} >> {e}")
+                attached_columns, reason = [], get_error_reason(e)
+            failed[key] = []
+            for row, column_list in self.rows[key]:
+                missing_columns = [column for column in column_list if column not in attached_columns]
+                if missing_columns:
+                    if reason == COLUMN_NOT_FOUND:
+                        print(f"Column Not Found: {self.project_id}.{dataset_name}.{table_name} >> {missing_columns}")
+                    if row is not None:
+                        set_error_reason(row, reason)
+                        failed[key].append(row)
+            return True
+
+        table_keys = list(self.assignments.keys())
+        run_partitioned(table_keys, lambda key: key, write_table, workers)
+        self.assignments = {}
+        self.rows = {}
+        return [row for key in table_keys for row in failed.get(key, [])]
+
+def queue_policy_tag_info(project_id, policy_tag_info, coalescer):
+    # resolve the policy tag of a row and queue it for its table
+    taxonomy = taxo_opr.get_taxonomies(project_id, policy_tag_info["taxonomy_location"], policy_tag_info["taxonomy"])
+    policy_tag = get_policy_tag(taxonomy, policy_tag_info["policy_tag"]) if taxonomy else ""
+    return queue_policy_tag(policy_tag_info, policy_tag, coalescer)
+
+def queue_policy_tag(policy_tag_info, policy_tag, coalescer):
+    # queue a row whose policy tag is resolved, shared with the asyncio counterpart of queue_policy_tag_info
+    if not policy_tag:
+        print(f"Policy Tag Not Found: {policy_tag_info['taxonomy']} >> {policy_tag_info['policy_tag']}")
+        return set_error_reason(policy_tag_info, POLICY_TAG_NOT_FOUND)
+    coalescer.add(policy_tag_info["dataset_name"], policy_tag_info["table_name"],
+                  policy_tag_info["column_names"].split(';'), policy_tag, policy_tag_info)
+    return True
+
+def policy_tag_row_table(policy_tag_info):
+    return (policy_tag_info.get("dataset_name", ""), policy_tag_info.get("table_name", ""))
+
+def attach_policy_tag_rows(project_id, policy_tag_info_list, job_config):
+    # attach policy tags for every row of a file and return the rows which failed.
+    # rows are resolved first, then every table gets one schema update with all of its columns.
+    coalescer = PolicyTagCoalescer(project_id)
+    workers = job_config.get("tag_workers", 1)
+    if job_config.get("execution_mode", "threads") == "asyncio":
+        import utils.async_operation as async_opr
+        failed_rows = async_opr.run_async(async_opr.queue_policy_tag_rows_async(
+            project_id, policy_tag_info_list, coalescer, job_config.get("async_concurrency", 100)))
+    else:
+        failed_rows = run_partitioned(policy_tag_info_list, policy_tag_row_table,
+                                      classify_errors(lambda policy_tag_info: queue_policy_tag_info(project_id, policy_tag_info, coalescer)),
+                                      workers)
+    return failed_rows + coalescer.flush(workers)
+
+def read_and_attach_policy_tag(file_name=None):
+    # file_name: process only this landing file, as uploaded in a gcs event, instead of the whole folder
     job_config = read_json("config/config.json")
 
     project_id = job_config["project_id"]
     landing_bucket = job_config["policy_tag_landing_bucket"]
     archive_bucket = job_config["policy_tag_archive_bucket"]
     policy_tag_folder = job_config["policy_tag_folder"]
-    temp_folder = job_config["temp_folder"]
 
-    err_rn = ""
     if job_config["run_local"]:
 
         for policy_tag_file in os.listdir("policy_tags/landing/"):
             if policy_tag_file.endswith(".csv"):
-                policy_tag_info_list = read_tag_csv(f"policy_tags/landing/{policy_tag_file}")
-                for policy_tag_info in policy_tag_info_list:
-
-                    # call function to tag each row
-                    taxonomy = taxo_opr.get_taxonomies(project_id, policy_tag_info["taxonomy_location"], policy_tag_info["taxonomy"])
-                    policy_tag = get_policy_tag(taxonomy, policy_tag_info["policy_tag"])
-                    result = attach_policy_tag(project_id, policy_tag_info["dataset_name"], policy_tag_info["table_name"],
-                                                policy_tag_info["column_names"].split(';'), policy_tag)
-
-                    # write error records to file
-                    if result == False:
-                        err_rn = policy_tag_file.replace("error_", "")
-                        file_exist = os.path.exists(f"policy_tags/error/error_{err_rn}")
-                        with open(f"tags/error/error_{err_rn}", 'a') as error_file:
-                            writer = csv.DictWriter(error_file, policy_tag_info.keys())
-                            if file_exist:
-                                writer.writerow(policy_tag_info)
-                            else:
-                                writer.writeheader()
-                                writer.writerow(policy_tag_info)
-                    print("-"*50)
-                
+                policy_tag_info_list = iter_tag_csv(f"policy_tags/landing/{policy_tag_file}")
+
+                # call function to tag each row
+                failed_rows = attach_policy_tag_rows(project_id, policy_tag_info_list, job_config)
+
+                # write error records to file
+                if failed_rows:
+                    write_error_rows(project_id, failed_rows, get_error_file_name("policy_tags", policy_tag_file))
+
                 os.rename(f"policy_tags/landing/{policy_tag_file}", f"policy_tags/processed/{policy_tag_file}.done")
 
     else:
-        gcs_list = list_file_gcs(project_id, landing_bucket, f"{policy_tag_folder}/")
-        for policy_tag_file in gcs_list:
-            if policy_tag_file.endswith(".csv"):
-                download_file_gcs(project_id, landing_bucket, policy_tag_file, f"{temp_folder}{policy_tag_file.split('/')[-1]}")
-                policy_tag_info_list = read_tag_csv(f"{temp_folder}{policy_tag_file.split('/')[-1]}")
-                for policy_tag_info in policy_tag_info_list:
-
-                    # call function to tag each row
-                    taxonomy = taxo_opr.get_taxonomies(project_id, policy_tag_info["taxonomy_location"], policy_tag_info["taxonomy"])
-                    policy_tag = get_policy_tag(taxonomy, policy_tag_info["policy_tag"])
-                    result = attach_policy_tag(project_id, policy_tag_info["dataset_name"], policy_tag_info["table_name"],
-                                                policy_tag_info["column_names"].split(';'), policy_tag)
-
-                    # write error records to file
-                    if result == False:
-                        err_rn = policy_tag_file.replace("error_", "").split('/')[-1]
-                        file_exist = os.path.exists(f"{temp_folder}error/error_{err_rn}")
-                        if not file_exist:
-                            os.makedirs(f"{temp_folder}error/")
-
-                        with open(f"{temp_folder}error/error_{err_rn}", 'a') as error_file:
-                            writer = csv.DictWriter(error_file, policy_tag_info.keys())
-                            if file_exist:
-                                writer.writerow(policy_tag_info)
-                            else:
-                                writer.writeheader()
-                                writer.writerow(policy_tag_info)
-                    print("-"*50)
-                
-                # upload error file to gcs
-                if os.path.exists(f"{temp_folder}error/error_{err_rn}"):    
-                    upload_file_to_gcs(project_id, archive_bucket, f"{temp_folder}error/error_{err_rn}", f"tags/error/error_{err_rn}")
-                    os.remove(f"{temp_folder}error/error_{err_rn}")
-                    os.removedirs(f"{temp_folder}error/")
-                    print("-"*50)
-                
-                os.remove(f"{temp_folder}{policy_tag_file.split('/')[-1]}")
-                move_file_gcs(project_id, landing_bucket, policy_tag_file, archive_bucket, f"{policy_tag_folder}/{policy_tag_file.split('/')[-1]}.done")
-
+        # processed files and their checkpoints are archived together at the end, even when a later file fails
+        archiver = GcsArchiver(project_id)
+        try:
+            gcs_list = [file_name] if file_name else list_file_gcs(project_id, landing_bucket, f"{policy_tag_folder}/")
+            for policy_tag_file in gcs_list:
+                if policy_tag_file.endswith(".csv"):
+                    # checkpoints are kept in the archive bucket, where saving them does not trigger the function
+                    checkpoint = open_checkpoint(project_id, landing_bucket, policy_tag_file, archive_bucket,
+                                                 job_config.get("checkpoint_folder", DEFAULT_CHECKPOINT_FOLDER))
+                    if checkpoint is None:
+                        continue
+                    # rows are read from the blob as they are processed, nothing is downloaded up front
+                    policy_tag_info_list = iter_csv_gcs(project_id, landing_bucket, policy_tag_file, generation=checkpoint.generation)
+
+                    # call function to tag each row, a retried invocation carries on after the last checkpoint
+                    try:
+                        failed_rows = process_with_checkpoint(policy_tag_info_list, checkpoint,
+                                                              lambda rows: attach_policy_tag_rows(project_id, rows, job_config),
+                                                              job_config.get("checkpoint_rows", DEFAULT_CHECKPOINT_ROWS))
+                    except CheckpointConflict as e:
+                        # the invocation which took the file over writes its errors and archives it
+                        print(f"Stopped, {e}")
+                        continue
+
+                    # write error records to gcs in one upload
+                    if failed_rows:
+                        write_error_rows(project_id, failed_rows, get_error_file_name(policy_tag_folder, policy_tag_file), archive_bucket)
+                        print("-"*50)
+
+                    archiver.add(landing_bucket, policy_tag_file, archive_bucket, f"{policy_tag_folder}/{policy_tag_file.split('/')[-1]}.done",
+                                 checkpoint.size, checkpoint.cleanup_objects(), checkpoint.generation)
+        finally:
+            archiver.archive()
+
+def replay_policy_tag_errors():
+    # retry only the quota and transient failures recorded in the policy tag error files
+    job_config = read_json("config/config.json")
+    project_id = job_config["project_id"]
 
+    if job_config["run_local"]:
+        replay_error_files(project_id, "policy_tags", lambda rows: attach_policy_tag_rows(project_id, rows, job_config))
+    else:
+        replay_error_files(project_id, job_config["policy_tag_folder"], lambda rows: attach_policy_tag_rows(project_id, rows, job_config),
+                           job_config["policy_tag_archive_bucket"])
+    return True
 
 def auto_attach_policy_tag(tag_info):
 
@@ -189,6 +309,7 @@ def auto_attach_policy_tag(tag_info):
 
     if "auto_policy_tag" in tag_info.keys() and tag_info["auto_policy_tag"]:
         print("\nAuto policy tag is enabled.")
+        import utils.dlp_operation as dlp_opr
 
         taxo_opr.create_taxonomy(project_id, taxonomy_info)     #create default taxonomy
         taxonomy = taxo_opr.get_taxonomies(project_id, dlp_taxonomy_loc, dlp_taxonomy)
@@ -202,11 +323,15 @@ def auto_attach_policy_tag(tag_info):
         print("DLP Generated fields:")
         print(dlp_fields)
 
+        # every detected column of the table is written with one schema update
+        coalescer = PolicyTagCoalescer(project_id)
         for info_dict in dlp_fields:
             column_name = info_dict["field_name"]
             tag_name = info_dict["info_types"]
             policy_tag = get_policy_tag(taxonomy, tag_name)
-            attach_policy_tag(project_id, tag_info["dataset_name"], tag_info["table_name"], column_list=[column_name], policy_tag=policy_tag)
+            if policy_tag:
+                coalescer.add(tag_info["dataset_name"], tag_info["table_name"], [column_name], policy_tag)
+        coalescer.flush()
 
         # clean up after running the job
         # dlp_opr.delete_dlp_bq_table(project_id, tag_info["dataset_name"], dlp_table_name)
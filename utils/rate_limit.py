@@ -0,0 +1,202 @@
+import asyncio
+import random
+import threading
+import time
+from google.api_core import exceptions as api_exceptions
+from utils.utils import read_json
+
+# errors worth another attempt, anything else is fatal for the row
+QUOTA_ERRORS = (api_exceptions.TooManyRequests, api_exceptions.ResourceExhausted)
+RETRYABLE_ERRORS = QUOTA_ERRORS + (api_exceptions.ServiceUnavailable, api_exceptions.DeadlineExceeded,
+                                   api_exceptions.InternalServerError, api_exceptions.BadGateway,
+                                   api_exceptions.GatewayTimeout, api_exceptions.Aborted, ConnectionError)
+
+# requests per second and concurrent calls per api, overridden by "api_rate_limits" and "api_max_concurrency" in config
+DEFAULT_RATE_LIMITS = {"datacatalog_read": 50, "datacatalog_write": 10, "policytag": 10, "bigquery": 10, "dlp": 5}
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 32.0
+
+class TokenBucket:
+    # token bucket whose rate is halved on quota errors and recovers slowly on success
+
+    def __init__(self, rate):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # take a token and return how long the caller has to wait before using it
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def throttle(self):
+        with self._lock:
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+class ConcurrencyLimit:
+    # limit of concurrent calls, halved on quota errors and raised by one after a run of successes
+
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = limit
+        self.active = 0
+        self.successes = 0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def decrease(self):
+        with self._cond:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+            print(f"Quota exhausted, concurrency lowered to {self.limit}")
+
+    def increase(self):
+        with self._cond:
+            self.successes += 1
+            if self.successes >= self.limit * 10 and self.limit < self.max_limit:
+                self.limit += 1
+                self.successes = 0
+                self._cond.notify()
+
+class ApiLimiter:
+    def __init__(self, api, rate, max_concurrency):
+        self.api = api
+        self.bucket = TokenBucket(rate)
+        self.concurrency = ConcurrencyLimit(max_concurrency)
+
+    def on_success(self):
+        self.bucket.recover()
+        self.concurrency.increase()
+
+    def on_quota_error(self):
+        self.bucket.throttle()
+        self.concurrency.decrease()
+
+_limiters = {}
+_settings = {}
+_lock = threading.Lock()
+
+def _load_settings():
+    if not _settings:
+        job_config = read_json("config/config.json")
+        rate_limits = dict(DEFAULT_RATE_LIMITS)
+        rate_limits.update(job_config.get("api_rate_limits", {}))
+        _settings["rate_limits"] = rate_limits
+        _settings["max_concurrency"] = job_config.get("api_max_concurrency", DEFAULT_MAX_CONCURRENCY)
+        _settings["max_retries"] = job_config.get("api_max_retries", DEFAULT_MAX_RETRIES)
+    return _settings
+
+def get_limiter(api):
+    limiter = _limiters.get(api)
+    if limiter is None:
+        with _lock:
+            settings = _load_settings()
+            limiter = _limiters.get(api)
+            if limiter is None:
+                limiter = ApiLimiter(api, settings["rate_limits"][api], settings["max_concurrency"])
+                _limiters[api] = limiter
+    return limiter
+
+def get_backoff(attempt):
+    # full jitter exponential backoff
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+def handle_retryable_error(limiter, error, attempt):
+    # returns the delay before the next attempt, raises when retries are exhausted
+    if isinstance(error, QUOTA_ERRORS):
+        limiter.on_quota_error()
+    if attempt >= _load_settings()["max_retries"]:
+        raise error
+    delay = get_backoff(attempt)
+    print(f"{limiter.api} call failed ({type(error).__name__}), retrying in {delay:.1f}s")
+    return delay
+
+def call_api(api, func, *args, **kwargs):
+    # call func under the rate and concurrency limits of api, retrying retryable errors with backoff
+    limiter = get_limiter(api)
+    attempt = 0
+    while True:
+        time.sleep(limiter.bucket.reserve())
+        limiter.concurrency.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            delay = handle_retryable_error(limiter, e, attempt)
+        else:
+            limiter.on_success()
+            return result
+        finally:
+            limiter.concurrency.release()
+        attempt += 1
+        time.sleep(delay)
+
+def call_api_pages(api, func, request, items_field):
+    # items of a paged list call, one page per call_api with the token of the previous page, so every page
+    # counts against the limits of api and a failed page is retried on its own. iterating the pager instead
+    # would fetch the pages after the first one outside of the limiter.
+    while True:
+        page = call_api(api, func, request=request)
+        for item in getattr(page, items_field):
+            yield item
+        if not page.next_page_token:
+            return
+        request.page_token = page.next_page_token
+
+async def call_api_pages_async(api, func, request, items_field):
+    # asyncio counterpart of call_api_pages, returns the items as a list
+    items = []
+    while True:
+        page = await call_api_async(api, func, request=request)
+        items.extend(getattr(page, items_field))
+        if not page.next_page_token:
+            return items
+        request.page_token = page.next_page_token
+
+async def call_api_async(api, func, *args, **kwargs):
+    # asyncio counterpart of call_api, func returns an awaitable
+    limiter = get_limiter(api)
+    attempt = 0
+    while True:
+        await asyncio.sleep(limiter.bucket.reserve())
+        while not limiter.concurrency.try_acquire():
+            await asyncio.sleep(0.05)
+        try:
+            result = await func(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            delay = handle_retryable_error(limiter, e, attempt)
+        else:
+            limiter.on_success()
+            return result
+        finally:
+            limiter.concurrency.release()
+        attempt += 1
+        await asyncio.sleep(delay)
@@ -1,261 +1,427 @@
-from utils.utils import read_json, read_tag_csv, prepare_dict
-from utils.gcs_operation import list_file_gcs, download_file_gcs, move_file_gcs, upload_file_to_gcs
-from utils.tmpl_operation import get_template, get_latest_template_id, get_all_latest_template_id
-import os, csv
+from utils.utils import read_json, iter_tag_csv, prepare_dict
+from utils.gcs_operation import list_file_gcs, iter_csv_gcs
+from utils.gcs_archiver import GcsArchiver
+from utils.tmpl_operation import get_cached_template, get_all_latest_template_id, clear_latest_template_cache, template_cache_stats
+import os, sys, threading
+from datetime import datetime
 from google.cloud import datacatalog
-from utils.policy_tag_operation import auto_attach_policy_tag
-import utils.dlp_operation as dlp_opr
-
-def get_entry(project, dataset, table):
-    # retrieve a project.dataset.table entry
-    datacatalog_client = datacatalog.DataCatalogClient()
+from utils.client_pool import get_datacatalog_client
+from utils.cache import LRUCache
+from utils.parallel import run_partitioned
+from utils.checkpoint import open_checkpoint, process_with_checkpoint, CheckpointConflict
+from utils.checkpoint import DEFAULT_CHECKPOINT_ROWS, DEFAULT_CHECKPOINT_FOLDER
+from utils.error_rows import set_error_reason, get_error_reason, classify_errors, write_error_rows, get_error_file_name, replay_error_files
+from utils.error_rows import pop_error_reason, merge_error_reasons
+from utils.error_rows import ENTRY_NOT_FOUND, COLUMN_NOT_FOUND, TEMPLATE_FIELD_MISMATCH
+from utils.rate_limit import call_api, call_api_pages
+from google.api_core import exceptions as api_exceptions
+
+# linked resource -> entry name, "" is cached for resources which do not exist
+ENTRY_NOT_FOUND_TTL = 60
+# lookup_entry answers PermissionDenied for resources which do not exist
+ENTRY_NOT_FOUND_ERRORS = (api_exceptions.NotFound, api_exceptions.PermissionDenied)
+_entry_cache = LRUCache("entry", maxsize=10000, ttl=3600)
+SEARCH_PAGE_SIZE = 500
+
+# create_tag answers these when the column of a column level tag does not exist
+COLUMN_NOT_FOUND_ERRORS = (api_exceptions.InvalidArgument, api_exceptions.NotFound, api_exceptions.FailedPrecondition)
+
+# fields is the only modifiable part of a tag, the mask overwrites it with the desired values
+TAG_UPDATE_MASK = {"paths": ["fields"]}
+
+# entry -> {(template name, column): tag}, loaded once per entry and kept in step with our own writes
+_tag_index = {}
+_tag_index_lock = threading.Lock()
+
+def get_linked_resource(project, dataset, table):
     resource_name = f"//bigquery.googleapis.com/projects/{project}"
     if dataset != "":
         resource_name = resource_name + f"/datasets/{dataset}"
     if table != "":
         resource_name = resource_name + f"/tables/{table}"
+    return resource_name
+
+def get_cached_entry(linked_resource):
+    # entry name of a linked resource, "" when known to be missing, None when not cached
+    return _entry_cache.get(linked_resource)
+
+def cache_entry(linked_resource, entry_name):
+    # store an already known entry name, e.g. from a catalog search. "" marks a missing entry.
+    if entry_name:
+        _entry_cache.set(linked_resource, entry_name)
+    else:
+        _entry_cache.set(linked_resource, "", ttl=ENTRY_NOT_FOUND_TTL)
+
+def get_entry(project, dataset, table):
+    # retrieve a project.dataset.table entry, "" if it does not exist
+    resource_name = get_linked_resource(project, dataset, table)
+    entry_name = get_cached_entry(resource_name)
+    if entry_name is not None:
+        return entry_name
 
+    datacatalog_client = get_datacatalog_client()
     try:
-        table_entry = datacatalog_client.lookup_entry(request={"linked_resource": resource_name})
-        return table_entry.name
-    except Exception:
+        table_entry = call_api("datacatalog_read", datacatalog_client.lookup_entry, request={"linked_resource": resource_name})
+        entry_name = table_entry.name
+    except ENTRY_NOT_FOUND_ERRORS:
+        # remember the miss for a short time so repeated rows do not look it up again,
+        # any other error is transient and is raised to the caller without being cached.
+        entry_name = ""
+    cache_entry(resource_name, entry_name)
+    return entry_name
+
+def search_entries(project_id, query):
+    # entry names of all catalog search results, keyed by linked resource, fetched in large pages
+    datacatalog_client = get_datacatalog_client()
+    scope = datacatalog.SearchCatalogRequest.Scope(include_project_ids=[project_id])
+    request = datacatalog.SearchCatalogRequest(scope=scope, query=query, page_size=SEARCH_PAGE_SIZE)
+    results = call_api_pages("datacatalog_read", datacatalog_client.search_catalog, request, "results")
+    return {result.linked_resource: result.relative_resource_name for result in results}
+
+def entry_cache_stats():
+    return _entry_cache.stats()
+
+def get_indexed_tags(table_entry):
+    # indexed tags of an entry, None when the entry has not been loaded yet
+    with _tag_index_lock:
+        return _tag_index.get(table_entry)
+
+def index_entry_tags(table_entry, tags):
+    entry_tags = {}
+    for tag in tags:
+        entry_tags[(tag.template, tag.column)] = tag
+    with _tag_index_lock:
+        return _tag_index.setdefault(table_entry, entry_tags)
+
+def load_entry_tags(table_entry):
+    # list the tags of an entry once and index them by (template, column)
+    entry_tags = get_indexed_tags(table_entry)
+    if entry_tags is None:
+        datacatalog_client = get_datacatalog_client()
+        request = datacatalog.ListTagsRequest()
+        request.parent = table_entry
+        entry_tags = index_entry_tags(table_entry, call_api_pages("datacatalog_read", datacatalog_client.list_tags, request, "tags"))
+    return entry_tags
+
+def clear_tag_index():
+    with _tag_index_lock:
+        _tag_index.clear()
+
+def get_tag_field_value(tag_field):
+    # read the value of a tag field whichever type it holds
+    kind = datacatalog.TagField.pb(tag_field).WhichOneof("kind")
+    if kind is None:
+        return None
+    if kind == "enum_value":
+        return tag_field.enum_value.display_name
+    return getattr(tag_field, kind)
+
+def format_tag_field_value(tag_field):
+    # text of a tag field value as written to the extract
+    value = get_tag_field_value(tag_field)
+    if value is None:
         return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def get_tag_values(tag):
+    return {key: get_tag_field_value(field) for key, field in tag.fields.items()}
+
+def get_tag_write_action(existing_tag, tag):
+    # create the tag when none exists, otherwise update it in place only when its values differ
+    if existing_tag is None:
+        return "Attached"
+    if get_tag_values(existing_tag) == get_tag_values(tag):
+        return "Unchanged"
+    return "Updated"
+
+def get_tag_key(tag):
+    return (tag.template, tag.column)
+
+def prepare_tag_write(tag, existing_tag):
+    # decide how the tag is written, an update keeps the name of the existing tag
+    action = get_tag_write_action(existing_tag, tag)
+    if action == "Updated":
+        tag.name = existing_tag.name
+    return action
+
+def record_written_tag(entry_tags, tag):
+    # keep the tag index in step with our own write
+    entry_tags[get_tag_key(tag)] = tag
+    return tag
+
+def write_tag(entry, tag, existing_tag):
+    datacatalog_client = get_datacatalog_client()
+    action = prepare_tag_write(tag, existing_tag)
+    if action == "Attached":
+        tag = call_api("datacatalog_write", datacatalog_client.create_tag, parent=entry, tag=tag)
+    elif action == "Updated":
+        tag = call_api("datacatalog_write", datacatalog_client.update_tag, tag=tag, update_mask=TAG_UPDATE_MASK)
+    else:
+        tag = existing_tag
+    return record_written_tag(load_entry_tags(entry), tag), action
 
-def remove_tag(table_entry, project, template, template_location, column_name=""):
-    # remove tag for a table
-
-    # list the tag related with table
-    datacatalog_client = datacatalog.DataCatalogClient()
-    request = datacatalog.ListTagsRequest()
-    request.parent = table_entry
-    gdc_tag_result = datacatalog_client.list_tags(request=request)
-    related_template = f"projects/{project}/locations/{template_location}/tagTemplates/{template}"
-    already_exist = False
-    tag_entry_name = ""
-
-    for tag in gdc_tag_result.tags:
-        if column_name == "":
-            if tag.template == related_template and tag.column == "":
-                already_exist = True
-                tag_entry_name = tag.name
-        else:
-            if tag.template == related_template and tag.column == column_name:
-                already_exist = True
-                tag_entry_name = tag.name
-
-    # delete if the tag is already existed.
-    if already_exist == True:
-        print("Tag with given template already existed.")
-        request = datacatalog.DeleteTagRequest()
-        request.name = tag_entry_name
-        result = datacatalog_client.delete_tag(request=request)
-        print("Tag Deleted.")
+def build_tag(tmpl, field_types, tag_info):
+    # build the tag of a csv row, only fields which are available in template are tagged
+    tag = datacatalog.Tag()
+    tag.template = tmpl.name
 
-    return True
+    # prepare dictionary to correct data types
+    result_tag_info = prepare_dict(tag_info)
+
+    for key, value in result_tag_info.items():
+        if key in field_types:
+            tag.fields[key] = datacatalog.TagField()
+
+            # get the field type from template according to field
+            field_type = field_types[key]
+
+            if field_type == "STRING":
+                tag.fields[key].string_value = value
+            if field_type == "DOUBLE":
+                tag.fields[key].double_value = value
+            if field_type == "BOOL":
+                tag.fields[key].bool_value = value
+            if field_type == "ENUM":
+                tag.fields[key].enum_value.display_name = value
+
+    # check column level tagging or not
+    if "column_name" in result_tag_info.keys():
+        tag.column = result_tag_info["column_name"]
+    return tag, result_tag_info
 
 def get_tag_info(project, dataset, table=""):
-    # get all the tag info related with dataset or table
-    datacatalog_client = datacatalog.DataCatalogClient()
-    request = datacatalog.ListTagsRequest()
+    # get all the tag info related with dataset or table, one row per tag field
+    datacatalog_client = get_datacatalog_client()
     entry = get_entry(project, dataset, table)
-    request.parent = entry
-    tags = datacatalog_client.list_tags(request=request)
+    if not entry:
+        return []
+    tags = call_api_pages("datacatalog_read", datacatalog_client.list_tags, datacatalog.ListTagsRequest(parent=entry), "tags")
     result = []
     for tag in tags:
-        tag_field = str(tag).split('fields ')[1:]
-        for field in tag_field:
-            tag_info = {"project_id":"", "dataset_name":"", "table_name":"", "column_name":"", 
-                        "template_id":"", "template_location":"", "tag_field_id":"", "tag_field_value":""}
-            tag_info["project_id"] = project
-            tag_info["dataset_name"] = dataset
-            tag_info["table_name"] = table
-            tag_info["column_name"] = tag.column
-            tag_info["template_id"] = tag.template.split("/")[-1]
-            tag_info["template_location"] = tag.template.split("/")[3]
-
-            # retrieve filed value manually as ther is no provided way
-            key = field.split("}")[0].split(":")[1].split('"')[1]
-            value = field.split("}")[0].split(":")[-1].strip().replace('"','')
-            tag_info["tag_field_id"] = key
-            tag_info["tag_field_value"] = value
-
-            result.append(tag_info)
-
+        template_parts = tag.template.split("/")
+        for key in sorted(tag.fields):
+            result.append({"project_id":project, "dataset_name":dataset, "table_name":table, "column_name":tag.column,
+                           "template_id":template_parts[-1], "template_location":template_parts[3],
+                           "tag_field_id":key, "tag_field_value":format_tag_field_value(tag.fields[key])})
     return result
 
-def attach_tag(project, template, template_location, tag_info, flag_auto_policy_tag):
-    # create a tag for a table
-    datacatalog_client = datacatalog.DataCatalogClient()
-    tag = datacatalog.Tag()
+# outcomes of attaching a tag, shared by attach_tag and its asyncio counterpart so only the api calls differ
 
-    # get template definition to define field types
-    print(f"Creating tag using template : {template}, location: {template_location}")
-    tmpl = get_template(project, template, template_location)
+def get_tag_target(result_tag_info):
+    # dataset and table a row tags, "" when not given
+    return result_tag_info.get("dataset_name") or "", result_tag_info.get("table_name") or ""
 
-    tag.template = tmpl.name
-    
-    # prepare dictionary to correct data types
-    result_tag_info = prepare_dict(tag_info)
-    dataset = result_tag_info["dataset_name"] if "dataset_name" in result_tag_info.keys() and result_tag_info["dataset_name"] != "" else ""
-    table = result_tag_info["table_name"] if "table_name" in result_tag_info.keys() and result_tag_info["table_name"] != "" else ""
-    
-    # flag for every fields not match with template
-    no_fields_match = True
+def template_field_mismatch(tag_info):
+    print("Matched fields no found in template. Skipped.")
+    return set_error_reason(tag_info, TEMPLATE_FIELD_MISMATCH)
 
-    # get fields from template to filter fields which are only availabe in template
-    tmpl_field = [field for field in tmpl.fields]
+def entry_lookup_failed(tag_info, target, error):
+    print(f"Entry lookup failed: {target} >> {error}")
+    return set_error_reason(tag_info, get_error_reason(error))
 
-    for key, value in result_tag_info.items():
+def entry_not_found(tag_info, target):
+    print(f"Not Found: {target}")
+    return set_error_reason(tag_info, ENTRY_NOT_FOUND)
 
-        if key in tmpl_field:
-            no_fields_match = False
-            tag.fields[key] = datacatalog.TagField()
+def tag_write_failed(tag_info, tag, target, error):
+    # retryable errors have already been retried, whatever is left fails the row
+    if tag.column and isinstance(error, COLUMN_NOT_FOUND_ERRORS):
+        print(f"Column Not Found: {target} >> {tag.column}")
+        return set_error_reason(tag_info, COLUMN_NOT_FOUND)
+    print(f"Tag write failed: {target} >> {error}")
+    return set_error_reason(tag_info, get_error_reason(error))
 
-            # get the field type from template according to field
-            field_type = tmpl.fields[key].type_
+def tag_written(tag, action, target):
+    if tag.column:
+        print(f"{action} Tag: {target} >> {tag.column}")
+    else:
+        print(f"{action} Tag: {target}")
 
-            if field_type.primitive_type:
-                if str(field_type.primitive_type) == 'PrimitiveType.STRING':
-                    tag.fields[key].string_value = value
-                if str(field_type.primitive_type) == 'PrimitiveType.DOUBLE':
-                    tag.fields[key].double_value = value
-                if str(field_type.primitive_type) == 'PrimitiveType.BOOL':
-                    tag.fields[key].bool_value = value
+def attach_tag(project, template, template_location, tag_info, flag_auto_policy_tag):
+    # create or update a tag for a table
 
-            if field_type.enum_type:
-                tag.fields[key].enum_value.display_name = value
+    # get template definition to define field types
+    print(f"Creating tag using template : {template}, location: {template_location}")
+    tmpl, field_types = get_cached_template(project, template, template_location)
+    tag, result_tag_info = build_tag(tmpl, field_types, tag_info)
+    if not tag.fields:
+        return template_field_mismatch(tag_info)
 
-    if no_fields_match:
-        print("Matched fields no found in template. Skipped.")
-        return False
+    dataset, table = get_tag_target(result_tag_info)
+    target = f"{project}.{dataset}.{table}"
 
-    # get table entry and remove tag if existed.
-    entry = get_entry(project, dataset, table)
-    if entry:
-        # check column level tagging or not
-        if "column_name" in result_tag_info.keys():
-            tag.column = result_tag_info["column_name"]
-            # remove column tag if existed
-            remove_tag(entry, project, template, template_location, result_tag_info["column_name"])
-            try:
-                tag = datacatalog_client.create_tag(parent=entry, tag=tag)
-                print(f"Attached Tag: {project}.{dataset}.{table} >> {tag.column}")
-                if flag_auto_policy_tag: auto_attach_policy_tag(result_tag_info)    # for policy tagging
-                return True
-            except Exception:
-                print(f"Column Not Found: {project}.{dataset}.{table} >> {tag.column}")
-                return False
-        else:
-            # remove table tag if existed
-            remove_tag(entry, project, template, template_location)
-            tag = datacatalog_client.create_tag(parent=entry, tag=tag)
-            print(f"Attached Tag: {project}.{dataset}.{table}")
-            if flag_auto_policy_tag: auto_attach_policy_tag(result_tag_info)    # for policy tagging
-            return True
-    else:
-        print(f"Not Found: {project}.{dataset}.{table}")
-        return False
+    # get table entry and the tag already attached with the template, if any.
+    try:
+        entry = get_entry(project, dataset, table)
+    except api_exceptions.GoogleAPICallError as e:
+        return entry_lookup_failed(tag_info, target, e)
+    if not entry:
+        return entry_not_found(tag_info, target)
 
-def read_and_attach_tag():
+    try:
+        existing_tag = load_entry_tags(entry).get(get_tag_key(tag))
+        tag, action = write_tag(entry, tag, existing_tag)
+    except api_exceptions.GoogleAPICallError as e:
+        return tag_write_failed(tag_info, tag, target, e)
+    tag_written(tag, action, target)
+    if flag_auto_policy_tag:
+        # policy tagging pulls in bigquery and dlp, so it is only imported when a row needs it
+        from utils.policy_tag_operation import auto_attach_policy_tag
+        auto_attach_policy_tag(result_tag_info)    # for policy tagging
+    return True
+
+def get_row_template_location(tag_info, default_tmpl_loc):
+    # use default template location if template location is not provided
+    if 'template_location' in tag_info.keys() and tag_info['template_location'] != "":
+        return tag_info['template_location']
+    return default_tmpl_loc
+
+def delete_dlp_table(project_id, tag_info):
+    # only rows with auto policy tagging create a dlp findings table
+    if prepare_dict(tag_info).get("auto_policy_tag"):
+        import utils.dlp_operation as dlp_opr
+        dlp_opr.delete_dlp_bq_table(project_id, tag_info["dataset_name"], tag_info["table_name"]+"_DLP")
+
+def stop_dlp_jobs():
+    # stop the dlp subscriber shared by the auto policy tagged rows of the run, dlp is only loaded if a row used it
+    dlp_opr = sys.modules.get("utils.dlp_operation")
+    if dlp_opr is not None:
+        dlp_opr.shutdown_dlp_job_managers()
+
+def attach_tag_info(project_id, tag_info, default_tmpl_loc):
+
+    # flag to prevent multiple auto policy tagging for the same table
+    flg_auto_policy_tag = True
+
+    tmplt_loc = get_row_template_location(tag_info, default_tmpl_loc)
+
+    # use default template if template id is not provided
+    if 'template_id' in tag_info.keys() and tag_info['template_id'] != "":
+        template = tag_info['template_id']
+        # attach tags
+        result = attach_tag(project_id, template, tmplt_loc, tag_info, flg_auto_policy_tag)
+        delete_dlp_table(project_id, tag_info)
+        return result
+    else:
+        # the row fails when a template matching its fields could not tag it, see merge_error_reasons
+        reasons = []
+        latest_tmpl_list = get_all_latest_template_id(project_id, "template_", tmplt_loc)
+        for tmpl in latest_tmpl_list:
+            # attach tags, an error of one template does not stop the others
+            result = classify_errors(lambda row: attach_tag(project_id, tmpl, tmplt_loc, row, flg_auto_policy_tag))(tag_info)
+            reasons.append(pop_error_reason(tag_info, result))
+            flg_auto_policy_tag = False
+        result = merge_error_reasons(tag_info, reasons)
+        delete_dlp_table(project_id, tag_info)
+        return result
+
+def tag_row_entry(tag_info):
+    # rows of the same table are handled in order by the same worker
+    return (tag_info.get("dataset_name", ""), tag_info.get("table_name", ""))
+
+def attach_tag_rows(project_id, tag_info_list, job_config):
+    # tag every row of a file and return the rows which failed
+    default_tmpl_loc = job_config["template_default_location"]
+    if job_config.get("execution_mode", "threads") == "asyncio":
+        import utils.async_operation as async_opr
+        return async_opr.run_async(async_opr.attach_tag_rows_async(
+            project_id, tag_info_list, default_tmpl_loc, job_config.get("async_concurrency", 100)))
+
+    def attach_tag_row(tag_info):
+        result = attach_tag_info(project_id, tag_info, default_tmpl_loc)
+        print("-"*50)
+        return result
+
+    return run_partitioned(tag_info_list, tag_row_entry, classify_errors(attach_tag_row), job_config.get("tag_workers", 1))
+
+def read_and_attach_tag(file_name=None):
+    # file_name: process only this landing file, as uploaded in a gcs event, instead of the whole folder
     job_config = read_json("config/config.json")
 
     project_id = job_config["project_id"]
     landing_bucket = job_config["tag_landing_bucket"]
     archive_bucket = job_config["tag_archive_bucket"]
     tag_folder = job_config["tag_folder"]
-    temp_folder = job_config["temp_folder"]
-    default_tmpl_loc = job_config["template_default_location"]          
-
-    def attach_tag_info(project_id, tag_info):
-        
-        # flag to prevent multiple auto policy tagging for the same table
-        flg_auto_policy_tag = True   
-
-        # use default template location if template location is not provided
-        if 'template_location' in tag_info.keys() and tag_info['template_location'] != "":
-            tmplt_loc = tag_info['template_location']
-        else:
-            tmplt_loc = default_tmpl_loc
-
-        # use default template if template id is not provided
-        if 'template_id' in tag_info.keys() and tag_info['template_id'] != "":
-            template = tag_info['template_id']
-            # attach tags
-            result = attach_tag(project_id, template, tmplt_loc, tag_info, flg_auto_policy_tag)
-            dlp_opr.delete_dlp_bq_table(project_id, tag_info["dataset_name"], tag_info["table_name"]+"_DLP")
-            return True
-        else:
-            latest_tmpl_list = get_all_latest_template_id(project_id, "template_", tmplt_loc)
-            for tmpl in latest_tmpl_list:
-                # attach tags
-                result = attach_tag(project_id, tmpl, tmplt_loc, tag_info, flg_auto_policy_tag)
-                flg_auto_policy_tag = False
-            dlp_opr.delete_dlp_bq_table(project_id, tag_info["dataset_name"], tag_info["table_name"]+"_DLP")
-            return True
-        return False
-
-    err_rn = ""
+
+    # tags written by an earlier run may have changed since, start from a fresh index
+    clear_tag_index()
+    # look up template versions once for the whole run
+    clear_latest_template_cache()
+
     if job_config["run_local"]:
 
         for tag_file in os.listdir("tags/landing/"):
             if tag_file.endswith(".csv"):
-                tag_info_list = read_tag_csv(f"tags/landing/{tag_file}")
-                for tag_info in tag_info_list:
-
-                    # call function to tag each row
-                    result = attach_tag_info(project_id, tag_info)
-
-                    # write error records to file
-                    if result == False:
-                        err_rn = tag_file.replace("error_", "")
-                        file_exist = os.path.exists(f"tags/error/error_{err_rn}")
-                        with open(f"tags/error/error_{err_rn}", 'a') as error_file:
-                            writer = csv.DictWriter(error_file, tag_info.keys())
-                            if file_exist:
-                                writer.writerow(tag_info)
-                            else:
-                                writer.writeheader()
-                                writer.writerow(tag_info)
-                    print("-"*50)
-                
+                tag_info_list = iter_tag_csv(f"tags/landing/{tag_file}")
+
+                # call function to tag each row
+                failed_rows = attach_tag_rows(project_id, tag_info_list, job_config)
+
+                # write error records to file
+                if failed_rows:
+                    write_error_rows(project_id, failed_rows, get_error_file_name("tags", tag_file))
+
                 os.rename(f"tags/landing/{tag_file}", f"tags/processed/{tag_file}.done")
 
     else:
 
-        gcs_list = list_file_gcs(project_id, landing_bucket, f"{tag_folder}/")
-        for tag_file in gcs_list:
-            if tag_file.endswith(".csv"):
-                download_file_gcs(project_id, landing_bucket, tag_file, f"{temp_folder}{tag_file.split('/')[-1]}")
-                tag_info_list = read_tag_csv(f"{temp_folder}{tag_file.split('/')[-1]}")
-                for tag_info in tag_info_list:
-
-                    # call function to tag each row
-                    result = attach_tag_info(project_id, tag_info)
-
-                    # write error records to file
-                    if result == False:
-                        err_rn = tag_file.replace("error_", "").split('/')[-1]
-                        file_exist = os.path.exists(f"{temp_folder}error/error_{err_rn}")
-                        if not file_exist:
-                            os.makedirs(f"{temp_folder}error/")
-
-                        with open(f"{temp_folder}error/error_{err_rn}", 'a') as error_file:
-                            writer = csv.DictWriter(error_file, tag_info.keys())
-                            if file_exist:
-                                writer.writerow(tag_info)
-                            else:
-                                writer.writeheader()
-                                writer.writerow(tag_info)
-                    print("-"*50)
-                
-                # upload error file to gcs
-                if os.path.exists(f"{temp_folder}error/error_{err_rn}"):    
-                    upload_file_to_gcs(project_id, archive_bucket, f"{temp_folder}error/error_{err_rn}", f"tags/error/error_{err_rn}")
-                    os.remove(f"{temp_folder}error/error_{err_rn}")
-                    os.removedirs(f"{temp_folder}error/")
-                    print("-"*50)
-                
-                os.remove(f"{temp_folder}{tag_file.split('/')[-1]}")
-                move_file_gcs(project_id, landing_bucket, tag_file, archive_bucket, f"{tag_folder}/{tag_file.split('/')[-1]}.done")
-
-    return True
\ No newline at end of file
+        # processed files and their checkpoints are archived together at the end, even when a later file fails
+        archiver = GcsArchiver(project_id)
+        try:
+            gcs_list = [file_name] if file_name else list_file_gcs(project_id, landing_bucket, f"{tag_folder}/")
+            for tag_file in gcs_list:
+                if tag_file.endswith(".csv"):
+                    # checkpoints are kept in the archive bucket, where saving them does not trigger the function
+                    checkpoint = open_checkpoint(project_id, landing_bucket, tag_file, archive_bucket,
+                                                 job_config.get("checkpoint_folder", DEFAULT_CHECKPOINT_FOLDER))
+                    if checkpoint is None:
+                        continue
+                    # rows are read from the blob as they are processed, nothing is downloaded up front
+                    tag_info_list = iter_csv_gcs(project_id, landing_bucket, tag_file, generation=checkpoint.generation)
+
+                    # call function to tag each row, a retried invocation carries on after the last checkpoint
+                    try:
+                        failed_rows = process_with_checkpoint(tag_info_list, checkpoint,
+                                                              lambda rows: attach_tag_rows(project_id, rows, job_config),
+                                                              job_config.get("checkpoint_rows", DEFAULT_CHECKPOINT_ROWS))
+                    except CheckpointConflict as e:
+                        # the invocation which took the file over writes its errors and archives it
+                        print(f"Stopped, {e}")
+                        continue
+
+                    # write error records to gcs in one upload
+                    if failed_rows:
+                        write_error_rows(project_id, failed_rows, get_error_file_name(tag_folder, tag_file), archive_bucket)
+                        print("-"*50)
+
+                    archiver.add(landing_bucket, tag_file, archive_bucket, f"{tag_folder}/{tag_file.split('/')[-1]}.done",
+                                 checkpoint.size, checkpoint.cleanup_objects(), checkpoint.generation)
+        finally:
+            archiver.archive()
+
+    stop_dlp_jobs()
+
+    # report cache efficiency for the run
+    for stats in [template_cache_stats(), entry_cache_stats()]:
+        print(f"Cache {stats['name']}: {stats['hits']} hits, {stats['misses']} misses")
+    return True
+
+def replay_tag_errors():
+    # retry only the quota and transient failures recorded in the tag error files
+    job_config = read_json("config/config.json")
+    project_id = job_config["project_id"]
+
+    clear_tag_index()
+    clear_latest_template_cache()
+
+    if job_config["run_local"]:
+        replay_error_files(project_id, "tags", lambda rows: attach_tag_rows(project_id, rows, job_config))
+    else:
+        replay_error_files(project_id, job_config["tag_folder"], lambda rows: attach_tag_rows(project_id, rows, job_config),
+                           job_config["tag_archive_bucket"])
+    stop_dlp_jobs()
+    return True
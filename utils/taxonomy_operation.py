@@ -1,30 +1,49 @@
 from google.cloud import datacatalog
 from utils.utils import read_json
+from utils.client_pool import get_policy_tag_manager_client
+from utils.rate_limit import call_api, call_api_pages
 import os
-from utils.gcs_operation import list_file_gcs, read_json_gcs, move_file_gcs
+from utils.gcs_operation import list_file_gcs, read_json_gcs_generation, file_exists_gcs
+from utils.gcs_archiver import archive_file
 import utils.policy_tag_operation as pt
+from utils.cache import LRUCache
+
+# (project, location) -> {taxonomy display name: taxonomy name}
+_taxonomy_index = LRUCache("taxonomy", maxsize=64, ttl=600)
 
 def list_taxonomies(project_id, location):
-    client = datacatalog.PolicyTagManagerClient()
+    client = get_policy_tag_manager_client()
     request = datacatalog.ListTaxonomiesRequest()
     request.parent = f"projects/{project_id}/locations/{location}"
 
-    taxonomy = client.list_taxonomies(request=request)
-    result = []
-    for t in taxonomy:
-        result.append(t)
-    return result
+    return list(call_api_pages("policytag", client.list_taxonomies, request, "taxonomies"))
+
+def lookup_taxonomy_index(project_id, location):
+    # display name -> taxonomy name from the cache, None on a miss
+    return _taxonomy_index.get((project_id, location))
+
+def cache_taxonomy_index(project_id, location, taxonomies):
+    # duplicate display names resolve to the lowest resource name, so the choice is the same on every run
+    index = {}
+    for taxo in sorted(taxonomies, key=lambda taxo: taxo.name):
+        if taxo.display_name in index:
+            print(f"""Duplicate taxonomy "{taxo.display_name}" in {location}, using {index[taxo.display_name]}""")
+        else:
+            index[taxo.display_name] = taxo.name
+    _taxonomy_index.set((project_id, location), index)
+    return index
+
+def invalidate_taxonomy_index(project_id, location):
+    _taxonomy_index.invalidate((project_id, location))
 
 def get_taxonomies(project_id, location, display_name):
-    taxonomies = list_taxonomies(project_id, location)
-    result = ""
-    for taxo in taxonomies:
-        if taxo.display_name == display_name:
-            result = taxo.name
-    return result
+    index = lookup_taxonomy_index(project_id, location)
+    if index is None:
+        index = cache_taxonomy_index(project_id, location, list_taxonomies(project_id, location))
+    return index.get(display_name, "")
 
 def create_taxonomy(project_id, taxonomy_info):
-    client = datacatalog.PolicyTagManagerClient()
+    client = get_policy_tag_manager_client()
 
     location = taxonomy_info["location"]
     display_name = taxonomy_info["taxonomy_display_name"]
@@ -36,8 +55,9 @@ def create_taxonomy(project_id, taxonomy_info):
         taxonomy.description = taxonomy_info["description"]
     
     try:
-        taxonomy = client.create_taxonomy(parent = f"projects/{project_id}/locations/{location}", taxonomy = taxonomy)
+        taxonomy = call_api("policytag", client.create_taxonomy, parent = f"projects/{project_id}/locations/{location}", taxonomy = taxonomy)
         print(f"""Taxonomy "{taxonomy.name}" created.""")
+        invalidate_taxonomy_index(project_id, location)
 
         # recursive function for sub_tag creation
         def sub_tag_creation(p_tag_info, parent_tag):
@@ -96,7 +116,8 @@ def create_taxonomy(project_id, taxonomy_info):
         print(f"""Taxonomy "{display_name}" already existed in "{location}".""")
         return False
 
-def create_taxonomy_from_file():
+def create_taxonomy_from_file(file_name=None):
+    # file_name: process only this landing file, as uploaded in a gcs event, instead of the whole folder
     job_config = read_json("config/config.json")
     project_id = job_config["project_id"]
     landing_bucket = job_config["taxonomy_landing_bucket"]
@@ -112,10 +133,18 @@ def create_taxonomy_from_file():
                     os.rename(f"taxonomy/landing/{taxo_file}", f"taxonomy/processed/{taxo_file}.done")
 
     else:
-        gcs_list = list_file_gcs(project_id, landing_bucket, f"{taxonomy_folder}/taxonomy")
+        if file_name:
+            # a redelivered event may name a file which is already archived
+            gcs_list = [file_name] if file_exists_gcs(project_id, landing_bucket, file_name) else []
+        else:
+            gcs_list = list_file_gcs(project_id, landing_bucket, f"{taxonomy_folder}/taxonomy")
         for taxo_file in gcs_list:
             if taxo_file.endswith(".json"):
-                taxonomy_info = read_json_gcs(project_id, landing_bucket, taxo_file)
+                taxonomy_info, generation = read_json_gcs_generation(project_id, landing_bucket, taxo_file)
+                if taxonomy_info is None:
+                    continue
                 result = create_taxonomy(project_id, taxonomy_info)
                 if result:
-                    move_file_gcs(project_id, landing_bucket, taxo_file, archive_bucket, f"{taxonomy_folder}/{taxo_file.split('/')[-1]}.done")
\ No newline at end of file
+                    # archived as soon as it is created, so a run killed later does not fail on it with "already exists"
+                    archive_file(project_id, landing_bucket, taxo_file, archive_bucket, f"{taxonomy_folder}/{taxo_file.split('/')[-1]}.done",
+                                 generation)
\ No newline at end of file
@@ -1,11 +1,19 @@
 from utils.utils import run_shell_cmd, read_json
-from utils.gcs_operation import list_file_gcs, read_json_gcs, move_file_gcs
+from utils.gcs_operation import list_file_gcs, read_json_gcs_generation, file_exists_gcs
+from utils.gcs_archiver import archive_file
 import os
 from google.cloud import datacatalog
+from utils.client_pool import get_datacatalog_client
+from utils.cache import LRUCache
+from utils.rate_limit import call_api, call_api_pages
 
-def create_template(project_id, template_id, location, display_name, fields):
-    # Create a Tag Template.
-    datacatalog_client = datacatalog.DataCatalogClient()
+# template definitions keyed by (project, template_id, location)
+_template_cache = LRUCache("tag_template", maxsize=256, ttl=600)
+# (project, location) -> {template prefix: (latest version, template id)}
+_latest_template_cache = LRUCache("latest_template", maxsize=32, ttl=600)
+
+def build_template(display_name, fields):
+    # build the tag template definition from the template json fields
     tag_template = datacatalog.TagTemplate()
 
     tag_template.display_name = display_name
@@ -27,18 +35,25 @@ def create_template(project_id, template_id, location, display_name, fields):
             for display_name in field["allowed_values"]:
                 enum_value = datacatalog.FieldType.EnumType.EnumValue(display_name=display_name)
                 tag_template.fields[field["id"]].type_.enum_type.allowed_values.append(enum_value)
+    return tag_template
+
+def create_template(project_id, template_id, location, display_name, fields):
+    # Create a Tag Template.
+    datacatalog_client = get_datacatalog_client()
+    tag_template = build_template(display_name, fields)
 
     expected_template_name = datacatalog.DataCatalogClient.tag_template_path(
         project_id, location, template_id
     )
     # Create the Tag Template.
     try:
-        tag_template = datacatalog_client.create_tag_template(
+        tag_template = call_api("datacatalog_write", datacatalog_client.create_tag_template,
             parent=f"projects/{project_id}/locations/{location}",
             tag_template_id=template_id,
             tag_template=tag_template,
         )
         print(f"Created template: {tag_template.name}")
+        record_created_template(project_id, template_id, location)
     except OSError as e:
         print(f"Cannot create template: {expected_template_name}")
         print(f"{e}")
@@ -46,48 +61,33 @@ def create_template(project_id, template_id, location, display_name, fields):
 
 def list_template(project_id):
     # list all the templates in project
-    datacatalog_client = datacatalog.DataCatalogClient()
+    datacatalog_client = get_datacatalog_client()
     scope = datacatalog.SearchCatalogRequest.Scope()
     scope.include_project_ids.append(project_id)
     result = []
-    templates = datacatalog_client.search_catalog(scope=scope, query=f'type=tag_template')
+    request = datacatalog.SearchCatalogRequest(scope=scope, query='type=tag_template')
+    templates = call_api_pages("datacatalog_read", datacatalog_client.search_catalog, request, "results")
     for tmpl in templates:
         result.append(tmpl.relative_resource_name)
     return result
 
 def get_template_info(project_id, template_id, location):
-    # get all the template info
+    # get all the template info, one row per field in field id order
     tmpl = get_template(project_id, template_id, location)
-    
+
     result = []
-    tmpl_field = str(tmpl).split('fields ')[1:]
-    for field in tmpl_field:
-        tmpl_info = {"project_id":"", "template_id":"", "template_display_name":"", "template_loc":"", 
-                    "field_id":"", "field_display_name":"", "field_type":"", "field_allowed_values":"",
-                    "requried_field":False, "field_description":""}
-        tmpl_info["project_id"] = project_id
-        tmpl_info["template_id"] = template_id
-        tmpl_info["template_loc"] = location
-        tmpl_info["template_display_name"] = tmpl.display_name
-        tmpl_info["field_id"] = field.split('\n')[1].split(':')[1].strip().replace('"','')
-        tmpl_info["field_display_name"] = (field.split('display_name:')[1].split('\n')[0].strip().replace('"','') 
-                                            if "display_name" in field else "")
-
-        if "enum_type" in field:
-            tmpl_info["field_type"] = "ENUM"
-            for value in field.split('type_')[1].split('\n'):
-                if "display_name" in value:
-                    tmpl_info["field_allowed_values"] = tmpl_info["field_allowed_values"] + value.split(':')[1].strip().replace('"','') + ";"
+    for field_id in sorted(tmpl.fields):
+        field = tmpl.fields[field_id]
+        if "enum_type" in field.type_:
+            field_type = "ENUM"
+            allowed_values = "".join(value.display_name + ";" for value in field.type_.enum_type.allowed_values)
         else:
-            tmpl_info["field_type"] = field.split('type_')[1].split('}')[0].split(':')[1].strip()
-        
-        tmpl_info["field_description"] = (field.split('description:')[1].split('\n')[0].strip().replace('"','') 
-                                            if "description" in field else "")
-
-        if "is_required" in field:
-            tmpl_info["requried_field"] = True
-        result.append(tmpl_info)
-        
+            field_type = field.type_.primitive_type.name
+            allowed_values = ""
+        result.append({"project_id":project_id, "template_id":template_id, "template_display_name":tmpl.display_name,
+                       "template_loc":location, "field_id":field_id, "field_display_name":field.display_name,
+                       "field_type":field_type, "field_allowed_values":allowed_values,
+                       "requried_field":field.is_required, "field_description":field.description})
     return result
 
 def check_template_exist(project_id, template_id, location):
@@ -102,63 +102,108 @@ def check_template_exist(project_id, template_id, location):
 
 def get_template(project_id, template_id, location):
     # get template definition
-    datacatalog_client = datacatalog.DataCatalogClient()
+    datacatalog_client = get_datacatalog_client()
     request = datacatalog.GetTagTemplateRequest()
     request.name = f'projects/{project_id}/locations/{location}/tagTemplates/{template_id}'
-    result = datacatalog_client.get_tag_template(request=request)
+    result = call_api("datacatalog_read", datacatalog_client.get_tag_template, request=request)
     return result
 
+def get_template_field_types(tmpl):
+    # map each template field id to STRING, DOUBLE, BOOL or ENUM
+    field_types = {}
+    for field_id, field in tmpl.fields.items():
+        if field.type_.enum_type:
+            field_types[field_id] = "ENUM"
+        elif field.type_.primitive_type:
+            field_types[field_id] = field.type_.primitive_type.name
+    return field_types
+
+def lookup_cached_template(project_id, template_id, location):
+    # (template, field types) from the cache, None on a miss
+    return _template_cache.get((project_id, template_id, location))
+
+def cache_template(project_id, template_id, location, tmpl):
+    cached = (tmpl, get_template_field_types(tmpl))
+    _template_cache.set((project_id, template_id, location), cached)
+    return cached
+
+def get_cached_template(project_id, template_id, location):
+    # get template definition and its field type map, fetching it only on a cache miss
+    cached = lookup_cached_template(project_id, template_id, location)
+    if cached is None:
+        tmpl = get_template(project_id, template_id, location)
+        cached = cache_template(project_id, template_id, location, tmpl)
+    return cached
+
+def invalidate_template(project_id, template_id, location):
+    _template_cache.invalidate((project_id, template_id, location))
+
+def template_cache_stats():
+    return _template_cache.stats()
+
 def delete_template(project_id, template_id, location):
     # check if existed and delete template
-    datacatalog_client = datacatalog.DataCatalogClient()
+    datacatalog_client = get_datacatalog_client()
     request = datacatalog.DeleteTagTemplateRequest()
     request.name = f'projects/{project_id}/locations/{location}/tagTemplates/{template_id}'
     request.force = True
     tmpl_exist = check_template_exist(project_id, template_id, location)
     if tmpl_exist:
-        result = datacatalog_client.delete_tag_template(request=request)
+        result = call_api("datacatalog_write", datacatalog_client.delete_tag_template, request=request)
+        invalidate_template(project_id, template_id, location)
+        _latest_template_cache.invalidate((project_id, location))
         print(f"Deleted: {request.name}")
         return result
 
+def parse_template_version(template_id):
+    # split "<prefix>_v_<number>" into (prefix, number), None when the template id is not versioned
+    parts = template_id.split("_")
+    if len(parts) >= 3 and parts[-2] == "v" and parts[-1].isdigit():
+        return "_".join(parts[:-2]), int(parts[-1])
+    return None
+
+def get_latest_template_map(project_id, location):
+    # template prefix -> (highest version, template id), built from a single search per location
+    latest = _latest_template_cache.get((project_id, location))
+    if latest is None:
+        datacatalog_client = get_datacatalog_client()
+        scope = datacatalog.SearchCatalogRequest.Scope()
+        scope.include_project_ids.append(project_id)
+        request = datacatalog.SearchCatalogRequest(scope=scope, query=f'type=tag_template location={location}')
+        results = call_api_pages("datacatalog_read", datacatalog_client.search_catalog, request, "results")
+        latest = {}
+        for result in results:
+            tmpl_id = result.relative_resource_name.split("/")[-1]
+            record_template_version(latest, tmpl_id)
+        _latest_template_cache.set((project_id, location), latest)
+    return latest
+
+def record_template_version(latest, template_id):
+    # versions are compared as numbers, so v_10 is newer than v_9
+    version = parse_template_version(template_id)
+    if version is not None:
+        prefix, number = version
+        if prefix not in latest or number > latest[prefix][0]:
+            latest[prefix] = (number, template_id)
+
+def record_created_template(project_id, template_id, location):
+    invalidate_template(project_id, template_id, location)
+    # search results lag behind creation, so the new version is recorded directly
+    latest = _latest_template_cache.get((project_id, location))
+    if latest is not None:
+        record_template_version(latest, template_id)
+
+def clear_latest_template_cache():
+    _latest_template_cache.clear()
+
 def get_latest_template_id(project_id, template_prefix, location):
-    datacatalog_client = datacatalog.DataCatalogClient()
-    scope = datacatalog.SearchCatalogRequest.Scope()
-    scope.include_project_ids.append(project_id)
-    results = datacatalog_client.search_catalog(scope=scope, query=f'type=tag_template location={location} name:{template_prefix}')
-    fetched_results = [result.relative_resource_name for result in results]
-    latest_tmpl = ""
-    if fetched_results:
-        if len(fetched_results) > 1:
-            max_version = max([tmpl.split("_")[-1] for tmpl in fetched_results])
-            for tmpl in fetched_results:
-                if tmpl.split("_")[-1] == max_version:
-                    latest_tmpl = tmpl.split("/")[-1]
-        else:
-            latest_tmpl = fetched_results[0].split("/")[-1]
-        return latest_tmpl
-    else:
-        return ""
+    latest = get_latest_template_map(project_id, location).get(template_prefix)
+    return latest[1] if latest else ""
 
 def get_all_latest_template_id(project_id, template_prefix, location):
-    datacatalog_client = datacatalog.DataCatalogClient()
-    scope = datacatalog.SearchCatalogRequest.Scope()
-    scope.include_project_ids.append(project_id)
-    results = datacatalog_client.search_catalog(scope=scope, query=f'type=tag_template location={location} name:{template_prefix}')
-    fetched_results = [result.relative_resource_name for result in results]
-
-    # get all template id prefixes
-    tmpl_set = []
-    for tmpl in fetched_results:
-        tmpl_prefix = (tmpl.split("/")[-1]).split("_")
-        tmpl_prefix = "_".join(tmpl_prefix[:-2])
-        tmpl_set.append(tmpl_prefix)
-    tmpl_set = set(tmpl_set)
-
-    # get latest version for each template
-    tmpl_list = []
-    for tmpl_prefix in tmpl_set:
-        tmpl_list.append(get_latest_template_id(project_id, tmpl_prefix, location))
-    return tmpl_list
+    # latest version of every template whose id starts with template_prefix
+    latest = get_latest_template_map(project_id, location)
+    return [latest[prefix][1] for prefix in sorted(latest) if prefix.startswith(template_prefix)]
 
 def generate_template_version(project_id, template_id, location):
     latest_tmpl_id = get_latest_template_id(project_id, template_id, location)
@@ -168,7 +213,47 @@ def generate_template_version(project_id, template_id, location):
     else:
         return template_id + "_v_0"
 
-def create_tag_template_from_file():
+def create_template_from_config(project_id, tmpl_cfg):
+    # get template version
+    tmpl_id = generate_template_version(project_id, tmpl_cfg["template_id"], tmpl_cfg["location"])
+
+    # delete template when existed
+    delete_template(project_id, tmpl_id, tmpl_cfg["location"])
+    return create_template(project_id, tmpl_id, tmpl_cfg["location"], tmpl_cfg["display_name"], tmpl_cfg["fields"])
+
+def create_templates(project_id, tmpl_cfg_list, job_config, on_created=None):
+    # create a new template version for each config and return a result per config.
+    # on_created(index) runs as soon as the template of a config is created, e.g. to archive its file
+    if job_config.get("execution_mode", "threads") == "asyncio":
+        import utils.async_operation as async_opr
+        return async_opr.run_async(async_opr.create_templates_async(
+            project_id, tmpl_cfg_list, job_config.get("async_concurrency", 100), on_created))
+    results = []
+    for index, tmpl_cfg in enumerate(tmpl_cfg_list):
+        # one failed config must not stop the others, their templates would be created again by a retry
+        try:
+            result = create_template_from_config(project_id, tmpl_cfg)
+        except Exception as e:
+            print(f"Cannot create template from config: {tmpl_cfg.get('template_id')} >> {e}")
+            result = False
+        if result and on_created:
+            on_created(index)
+        results.append(result)
+    return results
+
+def read_template_configs(tmpl_files, read_config):
+    # the files and configs which could be read, a broken file is left in landing
+    files, configs = [], []
+    for tmpl_file in tmpl_files:
+        try:
+            configs.append(read_config(tmpl_file))
+            files.append(tmpl_file)
+        except Exception as e:
+            print(f"Cannot read template config: {tmpl_file} >> {e}")
+    return files, configs
+
+def create_tag_template_from_file(file_name=None):
+    # file_name: process only this landing file, as uploaded in a gcs event, instead of the whole folder
     job_config = read_json("config/config.json")
 
     project_id = job_config["project_id"]
@@ -176,31 +261,44 @@ def create_tag_template_from_file():
     archive_bucket = job_config["template_archive_bucket"]
     template_folder = job_config["template_folder"]
 
+    # look up template versions once for the whole run
+    clear_latest_template_cache()
+
     if job_config["run_local"]:
+        tmpl_files = []
         for tmpl_file in os.listdir("tag_template/landing/"):
             if tmpl_file.startswith("template") and tmpl_file.endswith(".json"):
-                tmpl_cfg = read_json(f"tag_template/landing/{tmpl_file}")
-
-                # get template version
-                tmpl_id = generate_template_version(project_id, tmpl_cfg["template_id"], tmpl_cfg["location"])
-                
-                # delete template when existed
-                delete_template(project_id, tmpl_id, tmpl_cfg["location"])
-                result = create_template(project_id, tmpl_id, tmpl_cfg["location"], tmpl_cfg["display_name"], tmpl_cfg["fields"])
-                if result:
-                    os.rename(f"tag_template/landing/{tmpl_file}", f"tag_template/processed/{tmpl_file}.done")
+                tmpl_files.append(tmpl_file)
+        tmpl_files, tmpl_cfg_list = read_template_configs(tmpl_files, lambda tmpl_file: read_json(f"tag_template/landing/{tmpl_file}"))
+
+        results = create_templates(project_id, tmpl_cfg_list, job_config)
+        for tmpl_file, result in zip(tmpl_files, results):
+            if result:
+                os.rename(f"tag_template/landing/{tmpl_file}", f"tag_template/processed/{tmpl_file}.done")
     else:
-        gcs_list = list_file_gcs(project_id, landing_bucket, f"{template_folder}/template")
-        for tmpl_file in gcs_list:
-            if tmpl_file.endswith(".json"):
-                tmpl_cfg = read_json_gcs(project_id, landing_bucket, tmpl_file)
-
-                # get template version
-                tmpl_id = generate_template_version(project_id, tmpl_cfg["template_id"], tmpl_cfg["location"])
-
-                # delete template when existed
-                delete_template(project_id, tmpl_id, tmpl_cfg["location"])
-                result = create_template(project_id, tmpl_id, tmpl_cfg["location"], tmpl_cfg["display_name"], tmpl_cfg["fields"])
-                if result:
-                    move_file_gcs(project_id, landing_bucket, tmpl_file, archive_bucket, f"{template_folder}/{tmpl_file.split('/')[-1]}.done")
+        if file_name:
+            # a redelivered event may name a file which is already archived
+            gcs_list = [file_name] if file_exists_gcs(project_id, landing_bucket, file_name) else []
+        else:
+            gcs_list = list_file_gcs(project_id, landing_bucket, f"{template_folder}/template")
+        tmpl_files = [tmpl_file for tmpl_file in gcs_list if tmpl_file.endswith(".json")]
+
+        # the generation each file was read from, so a file uploaded again in the meantime is not archived unread
+        generations = {}
+
+        def read_config(tmpl_file):
+            tmpl_cfg, generations[tmpl_file] = read_json_gcs_generation(project_id, landing_bucket, tmpl_file)
+            if tmpl_cfg is None:
+                raise ValueError("already archived")
+            return tmpl_cfg
+
+        tmpl_files, tmpl_cfg_list = read_template_configs(tmpl_files, read_config)
+
+        def archive_template_file(index):
+            # archived as soon as its template is created, so a run killed later does not create another version
+            tmpl_file = tmpl_files[index]
+            archive_file(project_id, landing_bucket, tmpl_file, archive_bucket, f"{template_folder}/{tmpl_file.split('/')[-1]}.done",
+                         generations[tmpl_file])
+
+        create_templates(project_id, tmpl_cfg_list, job_config, archive_template_file)
     return True
\ No newline at end of file
@@ -18,6 +18,12 @@ def read_tag_csv(file_name):
             result.append(row)
     return result
 
+def iter_tag_csv(file_name):
+    # yield the rows of a csv file one at a time instead of loading the whole file
+    with open(file_name, newline='', encoding='utf-8-sig') as csvfile:
+        for row in csv.DictReader(csvfile):
+            yield row
+
 def dict_to_json(dict_obj ,filename):
     with open(filename, "w") as outfile:
         json.dump(dict_obj, outfile)